@@ -61,6 +61,10 @@ autodetect if a header is present or not.', type=click.Choice(['auto', 'yes', 'n
               default=75, show_default=True)
 @click.option('--nn_k', help='k in the nearest neighbour search.',
               default=10, show_default=True)
+@click.option('--nn_method', help='Method for the nearest neighbour search. "blocked" \
+computes exact distances in blocks using matrix multiplication, "ball_tree" uses a \
+ball tree.', type=click.Choice(['blocked', 'ball_tree']), default='blocked',
+              show_default=True)
 @click.option('--prune_snn', help='Threshold for pruning the SNN graph, i.e. the edges \
 with lower value (Jaccard index) than this will be removed. Set to 0 to disable \
 pruning. Increasing this value will result in fewer edges in the graph.',
@@ -73,6 +77,10 @@ RBERVertexPartition or ModularityVertexPartition.',
               show_default=True)
 @click.option('--leiden_res', help='Resolution parameter for the Leiden algorithm\
  (0-1).', default=0.8, show_default=True)
+@click.option('--leiden_res_sweep', help='Run the Leiden algorithm for several \
+resolutions (comma separated) on the same graph in parallel and write memberships, \
+number of clusters and modularity for each resolution. The clustering obtained with \
+--leiden_res is used for the rest of the analysis.', type=str, show_default=True)
 @click.option('--ignore_small_clusters', help='Ignore clusters with fewer or equal to N \
 cells.', default=10, show_default=True)
 @click.option('--annotations', help='An optional file containing gene descriptions. \
@@ -85,10 +93,19 @@ clustering. This option can be used if clustering has already been performed ext
 The file should contain two columns, delimited by a tab character, without header. The \
 first column should contain cell identifiers and the second column should contain the \
 cluster.', type=click.Path(exists=True), show_default=True)
+@click.option('--reference', help='Map the cells onto a finished alona run instead \
+of running the full analysis. Specify the output directory of the run. The cells are \
+normalized with the settings of the reference, projected onto its principal components \
+and assigned clusters and positions in its embedding from the nearest reference \
+cells.', type=click.Path(exists=True, file_okay=False), show_default=True)
 @click.option('--embedding', help='Method used for data projection. Can be either tSNE or \
 UMAP.', default='tSNE', type=click.Choice(['tSNE', 'UMAP']), show_default=True)
 @click.option('--perplexity', help='The perplexity parameter in the t-SNE algorithm.',
               default=30, show_default=True)
+@click.option('--sketch', help='Cluster and embed a representative subset of about \
+this many cells and transfer the results to the remaining cells. Speeds up the analysis \
+of very large datasets. 0 means all cells are used.', type=int, default=0,
+              show_default=True)
 @click.option('-s', '--species', help='Species your data comes from.',
               type=click.Choice(['human', 'mouse', 'other']), default='mouse',
               show_default=True)
@@ -96,8 +113,27 @@ UMAP.', default='tSNE', type=click.Choice(['tSNE', 'UMAP']), show_default=True)
               default=False, show_default=True)
 @click.option('--de_direction', help='Direction for differential gene expression analysis.',
               type=click.Choice(['any', 'up', 'down']), default='up')
+@click.option('--de_method', help='Statistical test for differential gene expression \
+analysis between clusters. "ttest" uses t-tests from a linear model, "wilcoxon" the \
+Wilcoxon rank-sum test.', type=click.Choice(['ttest', 'wilcoxon']), default='ttest',
+              show_default=True)
+@click.option('--de_long_format', help='File format of the table with all pairwise \
+comparisons of the differential expression analysis.',
+              type=click.Choice(['parquet', 'tsv']), default='parquet',
+              show_default=True)
+@click.option('--de_min_pct', help='Only test genes expressed in at least this \
+fraction of the cells in one of the two compared clusters.', type=float, default=0,
+              show_default=True)
+@click.option('--de_min_diff', help='Only test genes whose mean expression differs by \
+at least this much (log scale) between the two compared clusters.', type=float,
+              default=0, show_default=True)
 @click.option('--add_celltypes', help='Add markers for these additional cell types to \
 the heatmap plot. Separate multiple cell types with commas.', type=str, show_default=True)
+@click.option('--ct_permutations', help='Number of permutations of gene labels used \
+to compute empirical p-values of the cell type predictions. 0 disables.', type=int,
+              default=0, show_default=True)
+@click.option('--celltypes_per_cell', help='Also predict the cell type of every \
+cell, in addition to every cluster.', is_flag=True, default=False, show_default=True)
 @click.option('--overlay_genes', help='Generate scatter plots in 2d space (using method \
 specified by --embedding), where gene expression is overlaid on cells. Specify multiple \
 genes by comma separating gene symbols.', type=str, show_default=True)
@@ -109,6 +145,11 @@ cells by comma separating cell identifiers (usually barcodes).', type=str,
 expressed genes per cluster.', type=int, default=10, show_default=True)
 @click.option('--timestamp', help='Add timestamp label to plots.', is_flag=True,
               default=False, show_default=True)
+@click.option('--plots_only', help='Only render the plots, from the data saved in the \
+output directory (-o) by a previous run.', is_flag=True, default=False,
+              show_default=True)
+@click.option('--threads', help='Number of threads to use.', type=int, default=1,
+              show_default=True)
 @click.option('-lf', '--logfile', help='Name of log file. Set to /dev/null if you want to \
 disable logging to a file.', default='alona.log', show_default=True)
 @click.option('--loglevel', help='Set how much runtime information is written to \
@@ -121,10 +162,13 @@ the log file.', type=click.Choice(['regular', 'debug']), default='regular',
 @click.option('--version', help='Display version number.', is_flag=True,
               callback=print_version)
 def run(filename, output, dataformat, minreads, minexpgenes, qc_auto, mrnafull,
-        exclude_gene, delimiter, header, remove_mito, hvg, hvg_n, pca, pca_n, nn_k, prune_snn,
-        leiden_partition, leiden_res, ignore_small_clusters, annotations,
-        custom_clustering, embedding, perplexity, species, dark_bg, de_direction,
-        add_celltypes, overlay_genes, highlight_specific_cells, violin_top, timestamp,
+        exclude_gene, delimiter, header, remove_mito, hvg, hvg_n, pca, pca_n, nn_k,
+        nn_method, prune_snn, leiden_partition, leiden_res, leiden_res_sweep,
+        ignore_small_clusters, annotations, custom_clustering, reference,
+        embedding, perplexity, sketch, species, dark_bg, de_direction,
+        de_method, de_long_format, de_min_pct, de_min_diff, add_celltypes,
+        ct_permutations, celltypes_per_cell, overlay_genes,
+        highlight_specific_cells, violin_top, timestamp, plots_only, threads,
         logfile, loglevel, nologo, timeout, seed, version):
 
     # confirm the genome reference files can be found
@@ -155,11 +199,14 @@ tried: %s' % (GENOME[item], path))
         'minexpgenes': minexpgenes,
         'mrnafull': mrnafull,
         'nn_k': nn_k,
+        'nn_method': nn_method,
         'prune_snn': prune_snn,
         'dark_bg': dark_bg,
         'perplexity': perplexity,
+        'sketch': sketch,
         'leiden_partition': leiden_partition,
         'leiden_res': leiden_res,
+        'leiden_res_sweep': leiden_res_sweep,
         'ignore_small_clusters': ignore_small_clusters,
         'hvg_method': hvg,
         'hvg_n': hvg_n,
@@ -170,21 +217,36 @@ tried: %s' % (GENOME[item], path))
         'highlight_specific_cells': highlight_specific_cells,
         'violin_top': violin_top,
         'timestamp': timestamp,
+        'plots_only': plots_only,
         'add_celltypes': add_celltypes,
+        'ct_permutations': ct_permutations,
+        'celltypes_per_cell': celltypes_per_cell,
         'pca': pca,
         'pca_n': pca_n,
         'exclude_gene': exclude_gene,
         'annotations': annotations,
         'custom_clustering': custom_clustering,
+        'reference': reference,
         'de_direction': de_direction,
-        'timeout': timeout
+        'de_method': de_method,
+        'de_long_format': de_long_format,
+        'de_min_pct': de_min_pct,
+        'de_min_diff': de_min_diff,
+        'timeout': timeout,
+        'threads': threads
     }
 
     alonacell = AlonaFindmarkers()
     alonacell.set_params(alona_opts)
-    alonacell.prepare()
-    alonacell.load_data()
-    alonacell.analysis()
+    if plots_only:
+        alonacell.plots_only()
+    else:
+        alonacell.prepare()
+        alonacell.load_data()
+        if reference:
+            alonacell.map_to_reference()
+        else:
+            alonacell.analysis()
 
     time_end = time.time()
 
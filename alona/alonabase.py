@@ -79,6 +79,47 @@ class AlonaBase():
             log_warning('Recommended values of --perplexity is 5-50.')
         if self.params['hvg_n'] <= 0:
             log_error('--hvg must be a positive value')
+        if self.params['leiden_res_sweep']:
+            try:
+                [float(r) for r in self.params['leiden_res_sweep'].split(',')]
+            except ValueError:
+                log_error('--leiden_res_sweep must be a comma separated list of \
+numbers.')
+        if self.params['threads'] < 1:
+            log_error('--threads must be at least 1.')
+        if self.params['sketch'] < 0:
+            log_error('--sketch cannot be negative.')
+        if not 0 <= self.params['de_min_pct'] <= 1:
+            log_error('--de_min_pct must be between 0 and 1.')
+        if self.params['de_min_diff'] < 0:
+            log_error('--de_min_diff cannot be negative.')
+        if self.params['ct_permutations'] < 0:
+            log_error('--ct_permutations cannot be negative.')
+        if self.params['reference']:
+            self.load_reference_settings()
+
+    def load_reference_settings(self):
+        """ Cells mapped to a reference (`--reference`) must be normalized
+        and embedded in the same way as the reference cells. Reads the
+        settings of the reference run and overrides the corresponding
+        parameters. """
+        ref = self.params['reference']
+        settings_file = ref + OUTPUT['FILENAME_SETTINGS']
+        if not os.path.exists(settings_file):
+            log_error('%s does not look like an alona output directory \
+(settings.txt is missing).' % ref)
+        settings = {}
+        with open(settings_file, 'r') as f:
+            for line in f:
+                key, val = line.replace('\n', '').split('\t')
+                settings[key] = val
+        self.params['dataformat'] = settings['dataformat']
+        self.params['mrnafull'] = settings['mrnafull'] == 'True'
+        self.params['embedding'] = settings['embedding']
+        log_info('Using the settings of the reference: --dataformat %s, \
+--mrnafull %s, --embedding %s' % (self.params['dataformat'],
+                                  self.params['mrnafull'],
+                                  self.params['embedding']))
 
     def get_wd(self):
         """ Retrieves the name of the output directory. """
@@ -26,6 +26,10 @@ from .utils import (get_alona_dir, get_time)
 from .alonabase import AlonaBase
 #from .clustering import AlonaClustering
 
+# an Ensembl gene identifier (human or mouse, optionally with version),
+# alone or after a gene symbol and an underscore
+GENE_ID_PATTERN = r'^(?:(?P<symbol>.+)_)?(?P<ensembl>ENS(?:MUS)?G\d+)(?:\.\d+)?$'
+
 
 class AlonaCell(AlonaBase):
     """
@@ -40,6 +44,7 @@ class AlonaCell(AlonaBase):
         self.rRNA_genes = None
         self.pred = None
         self.preclust = None
+        self._gene_symbols = None
         super().__init__()
         # make matplotlib more quiet
         logging.getLogger('matplotlib').setLevel(logging.WARNING)
@@ -340,9 +345,63 @@ the moment.')
             log_info('Removed %s genes based on regexp.' % np.sum(r))
         log_debug('Exiting remove_genes_by_pattern()')
 
+    def ensembl_symbols(self):
+        """ Reads the table of Ensembl gene identifiers and gene symbols of
+        the species. Symbols belonging to more than one identifier are
+        left out.
+
+        Returns
+        =======
+        A pd.Series of upper case symbols indexed by identifier. """
+        if self.params['species'] == 'mouse':
+            f = GENOME['SYMBOLS_MOUSE']
+        else:
+            f = GENOME['SYMBOLS_HUMAN']
+        refs = pd.read_csv(get_alona_dir()+f, sep='\t', header=None,
+                           names=['id', 'symbol'])
+        refs = refs[np.logical_not(refs['symbol'].duplicated(keep=False))]
+        refs = refs.drop_duplicates('id')
+        return pd.Series(refs['symbol'].str.upper().values,
+                         index=refs['id'].str.upper())
+
+    def gene_symbols(self):
+        """ Resolves the gene identifiers of `data_norm` to upper case gene
+        symbols. Every identifier is classified in one pass as an Ensembl
+        gene identifier, a symbol followed by an Ensembl identifier
+        (symbol_identifier) or a plain symbol. Ensembl identifiers are
+        looked up in the table of the species (see ensembl_symbols()) and
+        give NaN if they are not found; for other species they are kept as
+        they are. The result is cached as long as the genes of `data_norm`
+        do not change.
+
+        Returns
+        =======
+        A pd.Index with the symbol of every row of `data_norm`. """
+        index = self.data_norm.index
+        if self._gene_symbols is not None and self._gene_symbols[0] is index:
+            return self._gene_symbols[1]
+        upper = index.astype(str).str.upper()
+        parts = upper.str.extract(GENE_ID_PATTERN)
+        symbols = parts['symbol'].to_numpy(dtype=object)
+        ensembl = parts['ensembl'].to_numpy(dtype=object)
+        plain = pd.isna(ensembl)
+        symbols[plain] = upper[plain]
+        ensembl_only = np.logical_not(plain) & pd.isna(symbols)
+        if np.any(ensembl_only):
+            if self.params['species'] in ['mouse', 'human']:
+                table = self.ensembl_symbols()
+                symbols[ensembl_only] = table.reindex(
+                    ensembl[ensembl_only]).to_numpy(dtype=object)
+            else:
+                symbols[ensembl_only] = upper[ensembl_only]
+        symbols = pd.Index(symbols, dtype=object)
+        self._gene_symbols = (index, symbols)
+        return symbols
+
     def load_annotations(self):
         """ Load gene annotations from file and make the matrix same
-        length as the data. """
+        length as the data. Genes are matched by identifier and otherwise
+        by gene symbol (see gene_symbols()). """
         anno_path = self.params['annotations']
         if not anno_path:
             return
@@ -350,15 +409,17 @@ the moment.')
             return
         anno = pd.read_csv(anno_path, sep='\t', header=None,
                            names=['gene', 'desc'])
-        anno = anno[anno['gene'].isin(self.data_norm.index)]
-        l = np.logical_not(self.data_norm.index.isin(anno['gene']))
-        missing = self.data_norm.index[l]
-        r = pd.DataFrame({'gene': missing, 'desc': [
-                         'no annotation']*len(missing)})
-        anno = anno.append(r, ignore_index=True)
-        anno.index = anno['gene']
-        anno = anno.reindex(self.data_norm.index)
-        self.anno = anno
+        anno = anno.drop_duplicates('gene')
+        desc = pd.Series(anno['desc'].values, index=anno['gene'].astype(str))
+        by_symbol = desc.groupby(desc.index.str.upper()).first()
+        genes = self.data_norm.index
+        found = desc.reindex(genes).to_numpy(dtype=object)
+        missing = pd.isna(found)
+        if np.any(missing):
+            symbols = self.gene_symbols()[missing]
+            found[missing] = by_symbol.reindex(symbols).to_numpy(dtype=object)
+        found[pd.isna(found)] = 'no annotation'
+        self.anno = pd.DataFrame({'gene': genes, 'desc': found}, index=genes)
 
     def load_preclustering(self):
         """ If the user has specified a premade clustering with
@@ -431,13 +492,22 @@ the moment.')
         else:
             self.find_variable_genes()
             self.PCA(pca_path)
-            self.embedding(embedding_path)
-        self.cluster()
+        if 0 < self.params['sketch'] < self.pca_components.shape[0]:
+            self.sketch_analysis(embedding_path)
+        else:
+            # nearest neighbours are shared by clustering and the embedding
+            self.neighbours()
+            if self.embeddings is None:
+                self.embedding(embedding_path)
+            self.cluster()
         self.discover_markers(direction=self.params['de_direction'])
         self.mean_exp()
         self.load_markers()
         self.CTA_RANK_F(marker_plot=True)
+        if self.params['celltypes_per_cell']:
+            self.CTA_per_cell()
         self.cell_scatter_plot(title='Colored by cluster')
         self.cell_scatter_plot_w_gene_overlay()
         self.genes_exp_per_cluster(title='Colored by cluster')
         self.violin_top()
+        self.render_plots()
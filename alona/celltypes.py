@@ -9,23 +9,30 @@
 import os
 import sys
 import subprocess
-from collections import defaultdict
 
 import numpy as np
 import pandas as pd
-from scipy.stats import fisher_exact
+from scipy import sparse
 from sklearn.preprocessing import scale
 from sklearn.preprocessing import MinMaxScaler
-import matplotlib.pyplot as plt
-import matplotlib.transforms as transforms
-import matplotlib.patches as patches
-import seaborn as sb
 
+import alona.plotting
 from .clustering import AlonaClustering
-from .constants import (OUTPUT, GENOME, MARKERS)
-from .log import (log_info, log_debug, log_error)
-from .utils import (get_alona_dir, get_time, uniqueColors)
-from .stats import p_adjust_bh
+from .constants import (OUTPUT, MARKERS)
+from .log import (log_info, log_debug, log_error, log_warning)
+from .utils import (get_alona_dir, uniqueColors, pool_context)
+from .stats import (p_adjust_bh, fisher_exact_greater)
+from .workers import (init_perm_worker, perm_worker, _PERM)
+
+# number of best scoring cell types reported per cell by CTA_per_cell()
+CELL_TYPES_PER_CELL = 3
+# number of cells scored at a time by CTA_per_cell()
+CELL_BLOCK_SIZE = 10000
+# approximate number of permuted Z-scores in one batch of permutations
+PERMUTATION_BATCH_VALUES = 2000000
+# smallest total number of permuted Z-scores for which the permutations are
+# run in worker processes
+PERMUTATION_PARALLEL_MIN_VALUES = 100000000
 
 
 class AlonaCellTypePred(AlonaClustering):
@@ -39,57 +46,109 @@ class AlonaCellTypePred(AlonaClustering):
         self.res_pred = None
         super().__init__()
 
-    def median_exp(self, data_norm):
+    def median_exp(self):
         """ Represent each cluster with median gene expression. """
         log_debug('median_exp() Computing median expression per cluster')
-        clust = self.leiden_cl
-        data = data_norm
         fn = self.get_wd() + OUTPUT['FILENAME_MEDIAN_EXP']
-        ret = data.groupby(clust, axis=1).aggregate(np.median)
-        ret = ret.iloc[:, ret.columns.isin(self.clusters_targets)]
+        ret = self.cluster_summary(self.data_norm, 'median')
+        out = ret
         if type(self.anno) == pd.core.frame.DataFrame:
-            ret = pd.concat([self.anno['desc'], ret], axis=1)
-        ret.to_csv(fn, header=True, sep='\t')
+            out = pd.concat([self.anno['desc'], ret], axis=1)
+        out.to_csv(fn, header=True, sep='\t')
         log_debug('median_exp() finished')
         return ret
 
     def mean_exp(self):
-        """ Represent each cluster with mean gene expression. """
+        """ Represent each cluster with mean gene expression. The means are
+        kept (exp_mean) for the plots. """
         log_debug('mean_exp() Computing mean expression per cluster')
-        clust = self.leiden_cl
-        data = self.data_norm
         fn = self.get_wd() + OUTPUT['FILENAME_MEAN_EXP']
-        ret = data.groupby(clust, axis=1).aggregate(np.mean)
-        ret = ret.iloc[:, ret.columns.isin(self.clusters_targets)]
-        #self.mean_expr = ret
+        ret = self.cluster_summary(self.data_norm, 'mean')
+        self.exp_mean = ret
         if type(self.anno) == pd.core.frame.DataFrame:
             ret = pd.concat([self.anno['desc'], ret], axis=1)
         ret.to_csv(fn, header=True, sep='\t')
         log_debug('mean_exp() finished')
 
-    def get_gene_symbols(self, data_norm):
-        if self.params['species'] == 'mouse':
-            f = GENOME['SYMBOLS_MOUSE']
-        else:
-            f = GENOME['SYMBOLS_HUMAN']
-        refs = pd.read_csv(get_alona_dir()+f, sep='\t', header=None)
-        refs.index = refs.iloc[:, 0]
-        t = refs.iloc[:, 1].value_counts() == 1
-        t = t[t]
-        refs = refs[refs.iloc[:, 1].isin(t.index)]
-        data_norm.index = data_norm.index.str.upper()
-        if not data_norm.index.str.match('ENSMU').any() and \
-           not data_norm.index.str.match('ENSG').any():
-            return data_norm
-        if data_norm.index.str.match(r'^ENS(G|MUS(G){0,1})\d+$').any(): #refactored and works
-            data_norm = data_norm.iloc[data_norm.index.isin(refs.index), :]
-            refs = refs.iloc[refs.index.isin(data_norm.index), :]
-            refs = refs.reindex(data_norm.index)
-            data_norm.index = refs.iloc[:, 1]
+    def marker_membership(self, index):
+        """ Membership of the gene symbols of the data in the marker gene
+        sets of the cell types (see load_markers()).
+
+        Arguments
+        =========
+        index : Gene symbols of the rows of the data (can be repeated).
+
+        Returns
+        =======
+        A tuple: the membership matrix (cell types x unique symbols, sparse
+        CSR with sorted indices), the cell types (sorted), the code of
+        every row of the data in the unique symbols and the unique
+        symbols. """
+        markers = self.markers
+        gene_key = markers.columns[0]
+        pos_codes, symbols = pd.factorize(index)
+        pairs = markers[[gene_key, 'cell type']].drop_duplicates()
+        ct_codes, cell_types = pd.factorize(pairs['cell type'], sort=True)
+        gene_codes = symbols.get_indexer(pairs[gene_key])
+        ok = (gene_codes >= 0) & (ct_codes >= 0)
+        member = sparse.csr_matrix((np.ones(np.sum(ok)),
+                                    (ct_codes[ok], gene_codes[ok])),
+                                   shape=(len(cell_types), len(symbols)))
+        member.sort_indices()
+        return member, np.asarray(cell_types), pos_codes, symbols
+
+    def weighted_rows(self, member, pos_codes, symbols):
+        """ Expands the membership matrix from marker_membership() to the
+        rows of the data and weights every marker gene. """
+        # Following this reasoning:
+        # Down-weighting overlapping genes improves gene set analysis
+        # Tarca AL, Draghici S, Bhatti G, Romero R
+        # BMC Bioinformatics 2012 13:136
+        freq = self.marker_freq
+        weights = 1+np.sqrt(((max(freq)-freq)/(max(freq)-min(freq))))
+        member_rows = member[:, pos_codes].tocsr()
+        member_rows.sort_indices()
+        row_weights = weights.reindex(symbols).values[pos_codes]
+        member_rows.data = member_rows.data*row_weights[member_rows.indices]
+        return member_rows
+
+    def permutation_pvalues(self, member_rows, median_expr_Z, norm,
+                            activity):
+        """ Empirical p-values of the activity scores of CTA_RANK_F(). The
+        gene labels of the Z-scores are permuted `--ct_permutations` times
+        and the p-value is (1 + number of permutations with a score at
+        least the observed one) / (1 + number of permutations).
+        Permutations are done in batches; one batch is a single product of
+        the marker matrix with the Z-scores of all its permutations. The
+        batches are distributed over `--threads` worker processes (unless
+        there are too few permutations to make up for starting them), each
+        batch with an independent random number stream spawned from
+        `--seed`, so results do not depend on the number of workers.
+
+        Returns
+        =======
+        An array of p-values (cell types x clusters). """
+        n_perm = self.params['ct_permutations']
+        log_debug('Running %s permutations of the gene labels' % n_perm)
+        batch = max(1, PERMUTATION_BATCH_VALUES//median_expr_Z.size)
+        sizes = [min(batch, n_perm - start) for start in
+                 range(0, n_perm, batch)]
+        streams = np.random.SeedSequence(self.params['seed']).spawn(
+            len(sizes))
+        tasks = list(zip(streams, sizes))
+        initargs = (member_rows, median_expr_Z, norm, activity)
+        workers = min(self.params['threads'], len(tasks))
+        if workers > 1 and \
+                n_perm*median_expr_Z.size >= PERMUTATION_PARALLEL_MIN_VALUES:
+            with pool_context().Pool(processes=workers,
+                                     initializer=init_perm_worker,
+                                     initargs=initargs) as pool:
+                counts = pool.map(perm_worker, tasks)
         else:
-            pass
-            # median_expr.index.str.extract('^(.+)_.+')[0].str.upper()
-        return data_norm
+            init_perm_worker(*initargs)
+            counts = [perm_worker(task) for task in tasks]
+            _PERM.clear()
+        return (1 + np.sum(counts, axis=0))/(1 + n_perm)
 
     def CTA_RANK_F(self, marker_plot=False):
         """ Cell Type Activity and Rank-based annotation with a
@@ -101,13 +160,10 @@ class AlonaCellTypePred(AlonaClustering):
         #import joblib
         #joblib.dump(self, 'q.jl')
         # sys.exit()
-        data_norm = self.data_norm.copy()
-        data_norm = self.get_gene_symbols(data_norm)
-        median_expr = self.median_exp(data_norm)
-        markers = self.markers
-        freq = self.marker_freq
-        input_symbols = median_expr.index
-        median_expr.index = input_symbols
+        symbols = self.gene_symbols()
+        mapped = np.asarray(symbols.notna())
+        median_expr = self.median_exp()[mapped]
+        median_expr.index = symbols[mapped]
         # (1) centering is done by subtracting the column means
         # (2) scaling is done by dividing the (centered) by their
         # standard deviations
@@ -115,70 +171,55 @@ class AlonaCellTypePred(AlonaClustering):
             scale(median_expr, with_mean=True, axis=0))
         median_expr_Z.index = median_expr.index
         median_expr_Z.columns = median_expr.columns
-        # reference symbols
-        #fn = get_alona_dir() + GENOME['MOUSE_GENE_SYMBOLS']
-        #mgs = pd.read_csv(fn, header=None)
-        #mgs = mgs[0].str.upper()
-        #markers = markers[markers[markers.columns[0]].isin(mgs)]
-        dd = defaultdict(list)
-        for item in markers.groupby('cell type'):
-            dd[item[0]] = set(item[1][item[1].columns[0]])
-        # Following this reasoning:
-        # Down-weighting overlapping genes improves gene set analysis
-        # Tarca AL, Draghici S, Bhatti G, Romero R
-        # BMC Bioinformatics 2012 13:136
-        #s = mgs.unique()
-        #s_freqs = marker_freq[marker_freq.index.isin(s)]
-        weights = 1+np.sqrt(((max(freq)-freq)/(max(freq)-min(freq))))
-
-        def _guess_cell_type(x):
-            rr = median_expr.loc[:, median_expr.columns ==
-                                 x.name].values.flatten()
-            # genes expressed in this cell cluster
-            genes_exp = set(x.index[rr > 0])
-            # genes _not_ expressed in this cell cluster
-            genes_not_exp = set(x.index[rr == 0])
-            res = list()
-            for ct in dd:
-                s = dd[ct]
-                x_ss = x[x.index.isin(s)]
-                if len(x_ss) == 0:
-                    continue
-                gene_weights = weights[weights.index.isin(x_ss.index)]
-                gene_weights = pd.Series(gene_weights, x_ss.index)
-                activity_score = sum(x_ss * gene_weights)/len(x_ss)**0.3
-                # how many expressed genesets are found in the geneset?
-                ct_exp = len(genes_exp & s)
-                # how many _non_ expressed genes are found in the geneset?
-                ct_non_exp = len(genes_not_exp & s)
-                # how many expressed genes are NOT found in the geneset?
-                ct_exp_not_found = len(genes_exp-s)
-                # how many _non_ expressed genes are NOT found in the geneset?
-                not_exp_not_found_in_geneset = len(genes_not_exp-s)
-                # one sided fisher
-                contigency_tbl = [[ct_exp, ct_non_exp],
-                                  [ct_exp_not_found,
-                                  not_exp_not_found_in_geneset]]
-                odds_ratio, pval = fisher_exact(
-                    contigency_tbl, alternative='greater')
-                markers_found = ','.join(list(genes_exp & s))
-                if markers_found == '':
-                    markers_found = 'NA'
-                res.append({'activity_score': activity_score,
-                            'ct': ct,
-                            'pvalue': pval,
-                            'markers': markers_found})
-            res = sorted(res, key=lambda k: k['activity_score'], reverse=True)
-            return res
-        ret = median_expr_Z.apply(func=_guess_cell_type, axis=0)
-        # restructure
+        member, cell_types, pos_codes, symbols = self.marker_membership(
+            median_expr_Z.index)
+        # the same per row of the data (gene symbols can occur more than once)
+        member_rows = self.weighted_rows(member, pos_codes, symbols)
+        # activity score: weighted sum of the Z-scores of the markers,
+        # divided by (number of markers)^0.3
+        n_found = np.diff(member_rows.indptr)
+        keep = n_found > 0
+        activity = (member_rows @ median_expr_Z.values)[keep]
+        # Python's power (per cell type) rounds like the scalar version
+        norm = np.array([k**0.3 for k in n_found[keep].tolist()])
+        activity = activity/norm[:, None]
+        # genes (symbols) expressed and _not_ expressed in every cluster
+        rows_to_symbols = sparse.csr_matrix(
+            (np.ones(len(pos_codes)), (pos_codes, np.arange(len(pos_codes)))),
+            shape=(len(symbols), len(pos_codes)))
+        genes_exp = (rows_to_symbols @ (median_expr.values > 0)) > 0
+        genes_not_exp = (rows_to_symbols @ (median_expr.values == 0)) > 0
+        member = member[keep]
+        cell_types = cell_types[keep]
+        # one sided fisher; contingency table per cell type and cluster:
+        # expressed/not expressed genes found/not found in the gene set
+        ct_exp = member @ genes_exp
+        ct_non_exp = member @ genes_not_exp
+        pvalues = fisher_exact_greater(ct_exp, ct_non_exp,
+                                       genes_exp.sum(axis=0) - ct_exp,
+                                       genes_not_exp.sum(axis=0) - ct_non_exp)
+        n_perm = self.params['ct_permutations']
+        if n_perm > 0:
+            emp_pvalues = self.permutation_pvalues(
+                member_rows[keep], median_expr_Z.values, norm, activity)
+            emp_col = []
         bucket = []
-        for i, k in enumerate(ret):
-            _df = pd.DataFrame(ret[k].to_list()) #refactored
-            _df['cluster'] = [i]*len(ret[k]) #refactored
-            cols = _df.columns.tolist()
-            _df = _df[cols[-1:]+cols[:-1]]
-            bucket.append(_df)
+        for i in range(median_expr_Z.shape[1]):
+            hits = genes_exp[member.indices, i]
+            markers_found = []
+            for j in range(len(cell_types)):
+                lo, hi = member.indptr[j], member.indptr[j+1]
+                found = symbols[member.indices[lo:hi][hits[lo:hi]]]
+                markers_found.append(','.join(found) if len(found) else 'NA')
+            order = np.argsort(-activity[:, i], kind='stable')
+            if n_perm > 0:
+                emp_col.append(emp_pvalues[order, i])
+            bucket.append(pd.DataFrame(
+                {'cluster': i,
+                 'activity_score': activity[order, i],
+                 'ct': cell_types[order],
+                 'pvalue': pvalues[order, i],
+                 'markers': np.array(markers_found, dtype=object)[order]}))
         final_tbl = pd.concat(bucket)
         padj = p_adjust_bh(final_tbl['pvalue'])
         final_tbl['padj_BH'] = padj
@@ -188,6 +229,8 @@ class AlonaCellTypePred(AlonaClustering):
                              'p-value',
                              'markers',
                              'adjusted p-value BH']
+        if n_perm > 0:
+            final_tbl['empirical p-value'] = np.concatenate(emp_col)
         fn = self.get_wd() + OUTPUT['FILENAME_CTA_RANK_F']
         final_tbl.to_csv(fn, sep='\t', index=False)
         # Save the best scoring for each cluster
@@ -197,7 +240,7 @@ class AlonaCellTypePred(AlonaClustering):
         fn = self.get_wd() + OUTPUT['FILENAME_CTA_RANK_F_BEST']
         self.res_pred.to_csv(fn, sep='\t', index=True)
         if marker_plot:
-            log_debug('Generating heatmap...')
+            log_debug('Preparing heatmap...')
             # additional cell types
             add_ct = self.params['add_celltypes']
             # sort on all the cell types that the gene occurs in
@@ -230,94 +273,99 @@ cell types were "Unknown".')
             ct_color = uniqueColors(len(ct_targets))
             gene = []
             celltypes = []
-            for item in dff.groupby(['value']):
+            for item in dff.groupby('value'):
                 gene.append(item[0])
                 celltypes.append(','.join(sorted(item[1]['cell type'].values)))
             dff = pd.DataFrame({'gene': gene, 'cell types': celltypes})
             dff = dff.sort_values('cell types')
             dff.index = np.arange(1, dff.shape[0]+1)
-            target_genes = dff.gene
-            symbs = data_norm.index
-            data_slice = data_norm.loc[symbs.isin(target_genes)]
-            cell_ids = pd.DataFrame({'ids': data_slice.columns.values,
-                                     'cluster': self.leiden_cl})
-            cell_ids = cell_ids[cell_ids['cluster'].isin(
-                self.clusters_targets)]
-            cell_ids = cell_ids.sort_values(by='cluster')
-            data_slice = data_slice.loc[:, data_slice.columns.isin(
-                cell_ids['ids'].values)]
-            data_slice = data_slice.reindex(cell_ids['ids'], axis=1)
-            data_slice = data_slice.reindex(dff['gene'], axis=0)
-            plt.clf()
-            fig_size_y = round(data_slice.shape[0]/8)  # 8 genes per inch
-            fig, ax = plt.subplots(
-                nrows=1, ncols=1, figsize=(15, fig_size_y))  # xy
-            ax = sb.heatmap(data_slice,
-                            linewidth=0,
-                            # controls size of the colorbar
-                            cbar_kws={"shrink": 0.5})
-            ax.get_xaxis().set_visible(False)
-            ax.get_yaxis().set_visible(False)
-            cbar = ax.collections[0].colorbar.ax
-            cbar.set_position([0.80, 0.6, 0.19, 0.19])
-            # setting ylim is needed due to matplotlib/seaborn bug
-            # shuld be highest to lowest or data will flip
-            ax.set_ylim([data_slice.shape[0], 0])
-            ax.set_xlim([0, data_slice.shape[1]])
-            # x coordinate is axes and y coordinate is data
-            trans = transforms.blended_transform_factory(
-                ax.transAxes, ax.transData)
-            # add gene labels
-            y_data_coord = 1  # data coordinates starts at 1
-            for gene in data_slice.index:
-                ax.text(x=-0.012-0.012*len(ct_targets), y=y_data_coord, s=gene,
-                        horizontalalignment='right', clip_on=False, size=7,
-                        transform=trans)
-                y_data_coord += 1
-            ax.collections[0].colorbar.ax.tick_params(labelsize=6)
-            ax.collections[0].colorbar.set_label(
-                'gene expression (log2 scale)', size=6)
-            grid = np.array(sorted(ct_targets))
-            # cell type labels
-            offset = -0.012-0.012*len(ct_targets)+0.006
-            for idx, ct in enumerate(grid):
-                ax.text(offset+idx*0.011, 0-0.50, ct, size=6,
-                        rotation=90, clip_on=False, transform=trans,
-                        color=ct_color[idx])
-            index = 0
-            for idx, d in dff.iterrows():
-                z = d[1].split(',')
-                for p in z:
-                    i = np.where(grid == p)[0][0]
-                    rect = patches.Rectangle((offset+i*0.011,
-                                             index+0.3), 0.005, 0.6,
-                                             linewidth=2,
-                                             facecolor=ct_color[i],
-                                             clip_on=False,
-                                             transform=trans)
-                    ax.add_patch(rect)
-                index += 1
-            # add cluster indicators
-            xmin = 0
-            xmax = 0
-            for cl in self.clusters_targets:
-                cell_count = np.sum(np.array(self.leiden_cl) == cl)
-                xmax += cell_count
-                col = self.cluster_colors[cl]
-                # y, xmin, xmax
-                ax.hlines(-0.5, xmin, xmax, color=col, clip_on=False, lw=4)
-                # cluster index
-                ax.text(x=xmin, y=-1.2, s=cl, size=5)
-                xmin += cell_count
-                # ax.get_xlim()[1]
-            if self.params['timestamp']:
-                plt.figtext(0.05, 0.05, get_time(), size=4)
-            fn = self.get_wd() + OUTPUT['FILENAME_MARKER_HEATMAP']
-            plt.savefig(fn, bbox_inches='tight')
-            #import joblib
-            # joblib.dump(self,'q.jl')
+            # first row of every gene symbol
+            symbols = self.gene_symbols()
+            dff = dff[dff['gene'].isin(symbols)]
+            rows = np.flatnonzero(symbols.isin(dff['gene']))
+            gene_rows = pd.Series(rows, index=symbols[rows])
+            gene_rows = gene_rows[np.logical_not(
+                gene_rows.index.duplicated())].reindex(dff['gene']).values
+            # cells ordered by cluster
+            cells = self.cluster_order[:self.cluster_offsets[-1]]
+            data_slice = self.data_norm.values[np.ix_(gene_rows, cells)]
+            fn = OUTPUT['FILENAME_MARKER_HEATMAP']
+            self.queue_plot(alona.plotting.marker_heatmap, fn=fn,
+                            data=data_slice,
+                            cell_counts=np.diff(self.cluster_offsets),
+                            genes=list(dff['gene']),
+                            gene_celltypes=list(dff['cell types']),
+                            ct_targets=ct_targets, ct_color=ct_color,
+                            clusters_targets=self.clusters_targets,
+                            cluster_colors=self.cluster_colors,
+                            timestamp=self.params['timestamp'])
         log_debug('CTA_RANK_F() finished')
 
+    def CTA_per_cell(self):
+        """ Scores every cell against every cell type, for clusters with
+        mixed cell types. The score is the activity score of CTA_RANK_F()
+        computed on the expression of the cell instead of the cluster
+        median: the weighted sum of the Z-scores (per cell) of the marker
+        genes, divided by (number of markers)^0.3. Z-scores are not formed
+        explicitly; the scores follow from the product of the weighted marker
+        matrix (cell types x genes) with the expression of the cells and the
+        mean and standard deviation of every cell. Cells are processed in
+        blocks of the expression matrix and the CELL_TYPES_PER_CELL best
+        scoring cell types of every cell are written to a table. """
+        if not self.params['species'] in ['mouse', 'human']:
+            log_info('"--species other", skipping per cell prediction')
+            return
+        log_debug('CTA_per_cell() starting')
+        symbols = self.gene_symbols()
+        rows = np.flatnonzero(symbols.notna())
+        member, cell_types, pos_codes, symbols = self.marker_membership(
+            symbols[rows])
+        weights = self.weighted_rows(member, pos_codes, symbols)
+        n_found = np.diff(weights.indptr)
+        keep = n_found > 0
+        cell_types = cell_types[keep]
+        if len(cell_types) == 0:
+            log_warning('no marker genes were found in the data, skipping \
+per cell prediction')
+            return
+        weights = weights[keep]
+        weight_sums = np.asarray(weights.sum(axis=1)).ravel()
+        norm = np.array([k**0.3 for k in n_found[keep].tolist()])
+        all_rows = len(rows) == self.data_norm.shape[0]
+        values = self.data_norm.values
+        n_cells = values.shape[1]
+        top = min(CELL_TYPES_PER_CELL, len(cell_types))
+        best_idx = np.empty((n_cells, top), dtype=np.int64)
+        best_score = np.empty((n_cells, top))
+        for start in range(0, n_cells, CELL_BLOCK_SIZE):
+            end = min(start + CELL_BLOCK_SIZE, n_cells)
+            if all_rows:
+                block = values[:, start:end]
+            else:
+                block = values[rows, start:end]
+            # same as sklearn's scale(): population standard deviation and
+            # scale 1 if the deviation is zero
+            mean = block.mean(axis=0)
+            sd = block.std(axis=0)
+            sd[sd == 0] = 1
+            score = np.asarray(weights @ block).T
+            score -= mean[:, None]*weight_sums
+            score /= sd[:, None]*norm
+            part = np.argpartition(-score, top-1, axis=1)[:, :top]
+            part_score = np.take_along_axis(score, part, axis=1)
+            order = np.argsort(-part_score, axis=1, kind='stable')
+            best_idx[start:end] = np.take_along_axis(part, order, axis=1)
+            best_score[start:end] = np.take_along_axis(part_score, order,
+                                                       axis=1)
+        tbl = pd.DataFrame({'cell': self.data_norm.columns,
+                            'cluster': self.leiden_cl})
+        for i in range(top):
+            tbl['cell type %s' % (i+1)] = cell_types[best_idx[:, i]]
+            tbl['score %s' % (i+1)] = best_score[:, i]
+        fn = self.get_wd() + OUTPUT['FILENAME_CTA_PER_CELL']
+        tbl.to_csv(fn, sep='\t', index=False)
+        log_debug('CTA_per_cell() finished')
+
     def load_markers(self):
         """ Load gene to cell type markers. """
         log_debug('Loading markers...')
@@ -4,9 +4,9 @@
 
     1. identify highly variable genes (HVG), retrieve N genes
     2. perform PCA on the HVG, retrieve N components 3. adjust PCAs by
-    weight 4. compute KNN 5. compute SNN from KNN, prune SNN graph
-    6. identify communities with leiden algo 7. run t-SNE or UMAP on
-    the PCAs
+    weight 4. compute KNN (shared with t-SNE and UMAP) 5. run t-SNE or UMAP on
+    the PCAs 6. compute SNN from KNN, prune SNN graph 7. identify
+    communities with leiden algo
 
  How to use alona: https://github.com/oscar-franzen/alona/
 
@@ -15,31 +15,41 @@
 import os
 import re
 import sys
+import warnings
 import joblib
 
 import numpy as np
 import pandas as pd
-import matplotlib.patches as mpatches
-import matplotlib.pyplot as plt
-import seaborn as sb
-import sklearn.manifold
 from sklearn.decomposition import PCA as sklearn_pca
 from sklearn.preprocessing import scale
 from sklearn.neighbors import NearestNeighbors
-from scipy.sparse import coo_matrix
+from scipy.sparse import (csr_matrix, save_npz, load_npz, triu)
 import scipy.linalg
 import umap
-import leidenalg
 import igraph as ig
 
 import alona.irlbpy
+import alona.tsne
+import alona.sketch
+import alona.plotting
+from .knn import knn_blocked, knn_cache_key, save_knn, load_knn
+from .stats import (cluster_means, cluster_medians)
 from .alonabase import AlonaBase
 from .cell import AlonaCell
 from .hvg import AlonaHighlyVariableGenes
 
 from .log import (log_info, log_debug, log_error, log_warning)
 from .constants import OUTPUT
-from .utils import (get_alona_dir, uniqueColors, get_time)
+from .utils import (get_alona_dir, uniqueColors, pool_context)
+from .workers import (leiden_partition, init_sweep_worker, sweep_worker,
+                      _SWEEP)
+
+
+# same as the default of umap.UMAP
+UMAP_N_NEIGHBORS = 15
+# smallest number of edges times resolutions for which the resolution sweep
+# is run in worker processes
+SWEEP_PARALLEL_MIN_EDGES = 1000000
 
 
 class AlonaClustering(AlonaCell):
@@ -52,9 +62,17 @@ class AlonaClustering(AlonaCell):
         self.pca_components = None
         self.embeddings = None  # pd.DataFrame
         self.nn_idx = None
+        self.nn_dist = None
+        self.nn_key = None  # identifies the input of the neighbour search
         self.snn_graph = None
         self.leiden_cl = None
+        self.sketch_cells = None  # positions of the sketch cells
+        self.sketch_nn = None  # sketch neighbours of every cell
         self.cluster_colors = []
+        self.cluster_order = None  # cells sorted by cluster
+        self.cluster_offsets = None  # offsets of the clusters in cluster_order
+        self.exp_mean = None  # mean expression per cluster (see mean_exp())
+        self.plot_jobs = []
         super().__init__()
 
         # Changing the font will remove '-' in tick labels
@@ -111,6 +129,9 @@ class AlonaClustering(AlonaCell):
             self.pca_components = np.dot(lanc.V, np.diag(lanc.s))
             self.pca_components = pd.DataFrame(
                 self.pca_components, index=sliced.columns)
+            # not centered; the components are the projections on U
+            loadings = pd.DataFrame(lanc.U, index=sliced.index)
+            loadings.insert(0, 'center', 0.0)
         elif self.params['pca'] == 'regular':
             sliced = sliced.transpose()
             x = scale(sliced, with_mean=True, with_std=False)
@@ -123,7 +144,12 @@ class AlonaClustering(AlonaCell):
             self.pca_components = retx
             self.pca_components = pd.DataFrame(
                 self.pca_components, index=sliced.index)
+            loadings = pd.DataFrame(v[:, 0:n_comp], index=sliced.columns)
+            loadings.insert(0, 'center', sliced.mean(axis=0).values)
         self.pca_components.to_csv(path_or_buf=out_path, sep=',', header=None)
+        # loadings are needed to project other cells (see map_to_reference())
+        fn = self.get_wd() + OUTPUT['FILENAME_PCA_LOADINGS']
+        loadings.to_csv(fn, header=True, index=True, index_label='gene')
         log_debug('Finished PCA')
 
     def embedding(self, out_path):
@@ -147,8 +173,16 @@ class AlonaClustering(AlonaCell):
         https://umap-learn.readthedocs.io/en/latest/ """
         log_debug('Entering UMAP()')
         seed = self.params['seed']
-        reducer = umap.UMAP(random_state=seed)
-        self.embeddings = reducer.fit_transform(self.pca_components)
+        # reuse the nearest neighbours of the clustering (see neighbours())
+        k = UMAP_N_NEIGHBORS
+        knn = (np.ascontiguousarray(self.nn_idx[:, :k]-1),
+               np.ascontiguousarray(self.nn_dist[:, :k]))
+        reducer = umap.UMAP(n_neighbors=k, random_state=seed,
+                            precomputed_knn=knn)
+        with warnings.catch_warnings():
+            # no search index is passed, it is only needed by transform()
+            warnings.filterwarnings('ignore', message='precomputed_knn')
+            self.embeddings = reducer.fit_transform(self.pca_components)
         self.embeddings = pd.DataFrame(self.embeddings,
                                        index=self.pca_components.index,
                                        columns=[1, 2])
@@ -157,34 +191,77 @@ class AlonaClustering(AlonaCell):
 
     def tSNE(self, out_path):
         """ Projects data to a two dimensional space using the tSNE
-        algorithm.
+        algorithm. Uses the FFT-accelerated interpolation-based
+        implementation in tsne.py with affinities computed from the 3 *
+        perplexity nearest neighbours, PCA initialization and early
+        exaggeration.
 
         van der Maaten, L.J.P.; Hinton, G.E. Visualizing
         High-Dimensional Data Using t-SNE. Journal of Machine Learning
-        Research 9:2579-2605, 2008.  """
+        Research 9:2579-2605, 2008.
+
+        Linderman GC, et al. Fast interpolation-based t-SNE for improved
+        visualization of single-cell RNA-seq data. Nature Methods
+        16:243-245, 2019. """
         log_debug('Running t-SNE...')
-        seed = self.params['seed']
         perplexity = self.params['perplexity']
-        tsne = sklearn.manifold.TSNE(n_components=2,
-                                     n_iter=2000,
-                                     perplexity=perplexity,
-                                     random_state=seed)
-        self.embeddings = tsne.fit_transform(self.pca_components)
+        threads = self.params['threads']
+        X = self.pca_components.values
+        # first neighbour is the cell itself
+        fn_knn = self.get_wd() + OUTPUT['FILENAME_KNN_PREFIX']
+        nn_idx, nn_dist = self.nn_search(self.tsne_k(), filename=fn_knn)
+        self.embeddings = alona.tsne.tsne(X, nn_idx[:, 1:], nn_dist[:, 1:],
+                                          perplexity=perplexity,
+                                          threads=threads)
         self.embeddings = pd.DataFrame(self.embeddings,
                                        index=self.pca_components.index,
                                        columns=[1, 2])
         self.embeddings.to_csv(path_or_buf=out_path, sep=',', header=None)
         log_debug('Finished t-SNE')
 
+    def nn_search(self, k, filename='', key=None):
+        """ Finds the k nearest neighbours of every cell in PCA space, the
+        cell itself being the first neighbour. The result is stored with
+        `filename` as prefix, keyed by a hash of the principal components
+        and k, and reused by later runs (and stages) needing at most as
+        many neighbours.
+
+        Returns
+        =======
+        A tuple of two arrays (cells x k): zero-based neighbour indices
+        and distances. """
+        if key is None:
+            key = knn_cache_key(self.pca_components.values,
+                                self.pca_components.index)
+        if filename:
+            cached = load_knn(filename, key, k)
+            if cached:
+                log_debug('Loading nearest neighbours from file...')
+                return cached
+        if self.params['nn_method'] == 'ball_tree':
+            nbrs = NearestNeighbors(n_neighbors=k, algorithm='ball_tree')
+            nbrs.fit(self.pca_components)
+            distances, indices = nbrs.kneighbors(self.pca_components)
+        else:
+            indices, distances = knn_blocked(self.pca_components.values, k,
+                                             threads=self.params['threads'])
+        if filename:
+            save_knn(filename, key, indices, distances)
+        return indices, distances
+
     def knn(self, inp_k, filename=''):
         """ Nearest Neighbour Search. Finds the k number of near
-        neighbours for each cell.  """
+        neighbours for each cell. The default method computes exact
+        distances in blocks using matrix multiplication, which is faster
+        than a ball tree in PCA space (75 dimensions by default). """
         log_debug('Performing Nearest Neighbour Search')
         k = inp_k
-        nbrs = NearestNeighbors(n_neighbors=k, algorithm='ball_tree')
-        nbrs.fit(self.pca_components)
-        indices = nbrs.kneighbors(self.pca_components)[1]
+        self.nn_key = knn_cache_key(self.pca_components.values,
+                                    self.pca_components.index)
+        indices, distances = self.nn_search(k, filename=filename,
+                                            key=self.nn_key)
         self.nn_idx = indices+1
+        self.nn_dist = np.asarray(distances, dtype=np.float64)
         log_debug('Finished NNS')
 
     def snn(self, k, prune_snn):
@@ -192,51 +269,49 @@ class AlonaClustering(AlonaCell):
         are number of shared nearest neighbors, so we need to get the
         sum of SNN similarities over all KNNs, which is done with a
         matrix operation.  See:
-        http://mlwiki.org/index.php/SNN_Clustering """
+        http://mlwiki.org/index.php/SNN_Clustering
+
+        Pruning is done on the sparse product directly. The graph is
+        kept as a sparse CSR matrix holding the Jaccard index of every
+        retained edge and stored in binary format (scipy npz). The file
+        name holds the key of the neighbour search input, k and prune_snn,
+        so a graph is only reused for the same cells and settings. """
         log_debug('Computing SNN graph...')
-        snn_path = self.get_wd() + OUTPUT['FILENAME_SNN_GRAPH']
+        snn_path = '%s%s_k%s_prune%s.npz' % (
+            self.get_wd() + OUTPUT['FILENAME_SNN_PREFIX'], self.nn_key, k,
+            prune_snn)
         if os.path.exists(snn_path):
             log_debug('Loading SNN from file...')
-            self.snn_graph = pd.read_csv(snn_path, header=None)
+            self.snn_graph = load_npz(snn_path)
             return
-        k_param = k
-        # create sparse matrix from tuples
-        melted = pd.DataFrame(self.nn_idx).melt(id_vars=[0])[[0, 'value']]
-        rows = np.array(melted[melted.columns[0]])
-        cols = np.array(melted[melted.columns[1]])
-        d = [1]*len(rows)
-        rows = np.array(list(melted[melted.columns[0]].values) +
-                        list(range(1, self.nn_idx.shape[0]+1)))
-        cols = np.array(list(melted[melted.columns[1]]) +
-                        list(list(range(1, self.nn_idx.shape[0]+1))))
-        d = [1]*len(rows)
-        knn_sparse = coo_matrix((d, (rows-1, cols-1)),
-                                shape=(self.nn_idx.shape[0],
-                                       self.nn_idx.shape[0]))
+        n_cells = self.nn_idx.shape[0]
+        # every cell is its own neighbour; duplicated entries are summed
+        # when the matrix is created and binarized below
+        rows = np.concatenate((np.repeat(np.arange(n_cells), k),
+                               np.arange(n_cells)))
+        cols = np.concatenate((self.nn_idx[:, :k].ravel()-1,
+                               np.arange(n_cells)))
+        d = np.ones(len(rows), dtype=np.int32)
+        knn_sparse = csr_matrix((d, (rows, cols)), shape=(n_cells, n_cells))
+        knn_sparse.data[:] = 1
         snn_sparse = knn_sparse*knn_sparse.transpose()
         # prune using same logic as FindClusters in Seurat
-        #aa = snn_sparse.nonzero()
-        cx = coo_matrix(snn_sparse)
-        node1 = []
-        node2 = []
-        pruned_count = 0
-        for i, j, v in zip(cx.row, cx.col, cx.data):
-            item = (i, j, v)
-            strength = v/(k+(k-v))
-
-            if strength > prune_snn:
-                node1.append(i)
-                node2.append(j)
-            else:
-                pruned_count += 1
-        perc_pruned = (pruned_count/len(cx.row))*100
+        v = snn_sparse.data
+        strength = v/(k+(k-v))
+        keep = strength > prune_snn
+        pruned_count = len(v)-np.sum(keep)
+        snn_sparse = csr_matrix((strength.astype(np.float32),
+                                 snn_sparse.indices, snn_sparse.indptr),
+                                shape=snn_sparse.shape)
+        snn_sparse.data[np.logical_not(keep)] = 0
+        snn_sparse.eliminate_zeros()
+        perc_pruned = (pruned_count/len(v))*100
         s = '{:,}'.format(pruned_count)
         log_debug('%.2f%% (n=%s) of links pruned' % (perc_pruned, s))
         if perc_pruned > 80:
             log_warning('more than 80% of the edges were pruned')
-        df = pd.DataFrame({'source_node': node1, 'target_node': node2})
-        df.to_csv(snn_path, header=None, index=None)
-        self.snn_graph = df
+        save_npz(snn_path, snn_sparse, compressed=False)
+        self.snn_graph = snn_sparse
         log_debug('Done computing SNN.')
 
     def leiden_prep(self):
@@ -258,6 +333,61 @@ class AlonaClustering(AlonaCell):
         if not self.cluster_colors:
             # generate some unique colors
             self.cluster_colors = uniqueColors(len(self.clusters_targets))
+        self.cluster_order, self.cluster_offsets = self._cluster_groups()
+
+    def _cluster_codes(self):
+        """ Integer codes of the clusters used for DE analysis. Cells in
+        clusters with too few cells get the code len(clusters).
+
+        Returns
+        =======
+        A tuple: the clusters and the codes of all cells. """
+        leiden_cl = np.array(self.leiden_cl)
+        keep = np.isin(leiden_cl, self.clusters_targets)
+        clusts = np.unique(leiden_cl[keep])
+        codes = np.full(len(leiden_cl), len(clusts))
+        codes[keep] = np.searchsorted(clusts, leiden_cl[keep])
+        return clusts, codes
+
+    def _cluster_groups(self):
+        """ Groups the cells by cluster, once for all plots. The cells of
+        clusters_targets[k] are cluster_order[offsets[k]:offsets[k+1]];
+        cells of clusters with too few cells come last.
+
+        Returns
+        =======
+        A tuple: positions of the cells sorted by cluster and the offsets of
+        the clusters in `clusters_targets`. """
+        clusts, codes = self._cluster_codes()
+        order = np.argsort(codes, kind='stable')
+        counts = np.bincount(codes, minlength=len(clusts)+1)[:len(clusts)]
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        return order, offsets
+
+    def cluster_summary(self, data, statistic='mean'):
+        """ Mean or median expression of every gene (rows of `data`) in
+        every cluster of `clusters_targets`, computed with the kernels
+        stats.cluster_means() and stats.cluster_medians().
+
+        Returns
+        =======
+        A data frame (genes x clusters). """
+        clusts, codes = self._cluster_codes()
+        if statistic == 'median':
+            ret = cluster_medians(data.values, codes, len(clusts))
+        else:
+            ret = cluster_means(data.values, codes, len(clusts))
+        return pd.DataFrame(ret, index=data.index, columns=clusts)
+
+    def snn_igraph(self):
+        """ Creates an undirected igraph object from the SNN graph in one
+        call. Every edge is added once (upper triangle of the symmetric
+        SNN matrix, without self loops) with the Jaccard index as weight. """
+        n_cells = self.snn_graph.shape[0]
+        edges = triu(self.snn_graph, k=1, format='coo')
+        return ig.Graph(n=n_cells,
+                        edges=np.column_stack((edges.row, edges.col)),
+                        edge_attrs={'weight': edges.data.astype(np.float64)})
 
     def leiden(self):
         """ Cluster the SNN graph using the Leiden algorithm.
@@ -270,28 +400,78 @@ class AlonaClustering(AlonaCell):
         log_debug('Running leiden clustering...')
         res = self.params['leiden_res']
         seed = self.params['seed']
-        # construct the graph object
-        nn = set(self.snn_graph[self.snn_graph.columns[0]])
-        g = ig.Graph()
-        g.add_vertices(len(nn))
-        g.vs['name'] = list(range(1, len(nn)+1))
-        ll = []
-        for i in self.snn_graph.itertuples(index=False):
-            ll.append(tuple(i))
-        g.add_edges(ll)
-        if self.params == 'ModularityVertexPartition':
-            part = leidenalg.ModularityVertexPartition
-        else:
-            part = leidenalg.RBERVertexPartition
-        cl = leidenalg.find_partition(g,
-                                      part,
-                                      n_iterations=10,
-                                      resolution_parameter=res,
-                                      seed=seed)
-        self.leiden_cl = cl.membership
+        g = self.snn_igraph()
+        cl = leiden_partition(g, self.params['leiden_partition'], res, seed)
+        self.leiden_cl = self.sketch_labels(cl.membership)
         self.leiden_prep()
         log_debug('Leiden has finished.')
 
+    def leiden_sweep(self):
+        """ Runs the Leiden algorithm for several resolutions (set with
+        `--leiden_res_sweep`). The graph is built once and the resolutions
+        are partitioned in parallel worker processes (`--threads`), unless
+        the graph is too small to make up for starting them.
+        Memberships for every resolution and a summary with the number of
+        clusters and the modularity are written to the csvs directory. The
+        clustering obtained with `--leiden_res` is used downstream. """
+        log_debug('Running leiden resolution sweep...')
+        res = self.params['leiden_res']
+        seed = self.params['seed']
+        partition = self.params['leiden_partition']
+        sweep = [float(r) for r in self.params['leiden_res_sweep'].split(',')]
+        if res not in sweep:
+            sweep.append(res)
+        g = self.snn_igraph()
+        workers = min(self.params['threads'], len(sweep))
+        if workers > 1 and g.ecount()*len(sweep) >= SWEEP_PARALLEL_MIN_EDGES:
+            with pool_context().Pool(processes=workers,
+                                     initializer=init_sweep_worker,
+                                     initargs=(g, partition, seed)) as pool:
+                out = pool.map(sweep_worker, sweep)
+        else:
+            init_sweep_worker(g, partition, seed)
+            out = [sweep_worker(r) for r in sweep]
+            _SWEEP.clear()
+        memberships = pd.DataFrame(
+            np.array([self.sketch_labels(o[0]) for o in out]).T,
+            index=self.data_norm.columns, columns=sweep)
+        fn = self.get_wd() + OUTPUT['FILENAME_LEIDEN_SWEEP']
+        memberships.to_csv(fn, header=True, index=True, index_label='cell')
+        summary = pd.DataFrame({'resolution': sweep,
+                                'clusters': memberships.nunique().values,
+                                'modularity': [o[1] for o in out]})
+        fn = self.get_wd() + OUTPUT['FILENAME_LEIDEN_SWEEP_SUMMARY']
+        summary.to_csv(fn, sep='\t', index=False)
+        for item in summary.itertuples(index=False):
+            log_debug('resolution=%s clusters=%s modularity=%.4f' % item)
+        self.leiden_cl = list(memberships[res])
+        self.leiden_prep()
+        log_debug('Leiden sweep has finished.')
+
+    def tsne_k(self):
+        """ Number of neighbours (including the cell itself) used for the
+        t-SNE affinities, i.e. 3 * perplexity. """
+        n_cells = self.pca_components.shape[0]
+        return min(n_cells-1, int(3*self.params['perplexity'])) + 1
+
+    def neighbours(self):
+        """ Computes the nearest neighbours (with distances) shared by the
+        SNN graph, t-SNE and UMAP. Enough neighbours are computed for all
+        stages needing them and each stage uses the first k columns; the
+        SNN graph uses the first `--nn_k`. The result is stored and reused
+        when resuming. """
+        need_snn = type(self.preclust) != pd.core.frame.DataFrame
+        need_embedding = self.embeddings is None
+        if not (need_snn or need_embedding):
+            return
+        k = self.params['nn_k']
+        if need_embedding and self.params['embedding'] == 'UMAP':
+            k = max(k, UMAP_N_NEIGHBORS)
+        elif need_embedding:
+            k = max(k, self.tsne_k())
+        fn_knn = self.get_wd() + OUTPUT['FILENAME_KNN_PREFIX']
+        self.knn(k, filename=fn_knn)
+
     def cluster(self):
         """ Clusters or loads a pre-made clustering. """
         if type(self.preclust) == pd.core.frame.DataFrame:
@@ -305,368 +485,299 @@ class AlonaClustering(AlonaCell):
             self.leiden_prep()
         else:
             k = self.params['nn_k']
-            fn_knn_map = self.get_wd() + OUTPUT['FILENAME_KNN_map']
-            self.knn(k, filename=fn_knn_map)
             self.snn(k, self.params['prune_snn'])
-            self.leiden()
+            if self.params['leiden_res_sweep']:
+                self.leiden_sweep()
+            else:
+                self.leiden()
+
+    def sketch_analysis(self, embedding_path):
+        """ Runs the neighbour search, the embedding and the clustering on a
+        sketch of about `--sketch` cells selected with density-dependent
+        downsampling in PCA space (see sketch.py). The clusters and 2D
+        positions of the remaining cells are transferred from their
+        `--nn_k` nearest sketch cells: the cluster by weighted majority
+        vote and the position as the weighted mean position of the
+        neighbours in the assigned cluster. The results are written to the
+        usual files. """
+        log_debug('Entering sketch_analysis()')
+        full = self.pca_components
+        seed = self.params['seed']
+        threads = self.params['threads']
+        self.sketch_cells = alona.sketch.density_sample(
+            full.values, self.params['sketch'], seed=seed, threads=threads)
+        log_info('sketch contains %s of %s cells' % (len(self.sketch_cells),
+                                                       full.shape[0]))
+        fn = self.get_wd() + OUTPUT['FILENAME_SKETCH']
+        pd.Series(full.index[self.sketch_cells]).to_csv(fn, header=False,
+                                                        index=False)
+        sketch = full.iloc[self.sketch_cells]
+        k = min(self.params['nn_k'], sketch.shape[0])
+        self.sketch_nn = knn_blocked(full.values, k, y=sketch.values,
+                                     threads=threads)
+        # neighbours and embedding of the sketch
+        self.pca_components = sketch
+        self.neighbours()
+        if self.embeddings is None:
+            method = self.params['embedding']
+            sketch_path = self.get_wd() + \
+                OUTPUT['FILENAME_EMBEDDING_PREFIX'] + method + '_sketch.csv'
+            self.embedding(sketch_path)
+            sketch_embeddings = self.embeddings.values
+        else:
+            sketch_embeddings = None
+        self.pca_components = full
+        # clustering of the sketch, transferred to all cells in leiden()
+        self.cluster()
+        if sketch_embeddings is not None:
+            nn_idx, nn_dist = self.sketch_nn
+            if type(self.preclust) == pd.core.frame.DataFrame:
+                # a custom clustering is not in the order of the cells
+                pos = alona.sketch.transfer_positions(nn_idx, nn_dist,
+                                                      sketch_embeddings)
+            else:
+                labels = np.asarray(self.leiden_cl)
+                pos = alona.sketch.transfer_positions(
+                    nn_idx, nn_dist, sketch_embeddings,
+                    nn_labels=labels[self.sketch_cells][nn_idx],
+                    labels=labels)
+            pos[self.sketch_cells] = sketch_embeddings
+            self.embeddings = pd.DataFrame(pos, index=full.index,
+                                           columns=[1, 2])
+            self.embeddings.to_csv(path_or_buf=embedding_path, sep=',',
+                                   header=None)
+        log_debug('Exiting sketch_analysis()')
+
+    def sketch_labels(self, labels):
+        """ Transfers the cluster labels of the sketch cells to all cells.
+        Returns the labels unchanged if sketching is not used. """
+        if self.sketch_nn is None:
+            return labels
+        labels = np.asarray(labels)
+        nn_idx, nn_dist = self.sketch_nn
+        assigned, fraction = alona.sketch.transfer_labels(nn_idx, nn_dist,
+                                                          labels)
+        assigned[self.sketch_cells] = labels
+        log_debug('median vote fraction of transferred labels: %.2f' %
+                  np.median(fraction))
+        return list(assigned)
+
+    def map_to_reference(self):
+        """ Maps the cells onto a finished alona run (`--reference`)
+        instead of running the analysis. The cells have been normalized
+        with the settings of the reference run and are projected onto its
+        principal components using the stored loadings of its highly
+        variable genes. The principal components of the reference cells
+        serve as the search index: every cell is assigned the cluster with
+        the most votes (weighted by inverse distance) among its `--nn_k`
+        nearest reference cells and placed at the weighted mean position
+        of those neighbours in the same cluster of the reference
+        embedding. """
+        log_debug('Entering map_to_reference()')
+        ref = self.params['reference']
+        method = self.params['embedding']
+        files = {'loadings': ref + OUTPUT['FILENAME_PCA_LOADINGS'],
+                 'pca': ref + OUTPUT['FILENAME_PCA'],
+                 'clusters': ref + OUTPUT['FILENAME_CLUSTERS_LEIDEN'],
+                 'embeddings': ref + OUTPUT['FILENAME_EMBEDDING_PREFIX'] +
+                               method + '.csv'}
+        for item in files:
+            if not os.path.exists(files[item]):
+                log_error('Cannot find %s of the reference (%s). The \
+reference must be a finished alona run.' % (item, files[item]))
+        loadings = pd.read_csv(files['loadings'], index_col=0)
+        ref_pca = pd.read_csv(files['pca'], header=None, index_col=0)
+        ref_cl = pd.read_csv(files['clusters'], header=None, index_col=0)
+        ref_emb = pd.read_csv(files['embeddings'], header=None, index_col=0)
+        ref_cl = ref_cl.reindex(ref_pca.index).iloc[:, 0].values
+        ref_emb = ref_emb.reindex(ref_pca.index).values
+        center = loadings.pop('center').values
+        missing = np.sum(np.logical_not(
+            loadings.index.isin(self.data_norm.index)))
+        if missing > 0:
+            log_warning('%s of %s highly variable genes of the reference are \
+missing and set to zero' % (missing, loadings.shape[0]))
+        x = self.data_norm.reindex(loadings.index, fill_value=0).transpose()
+        self.pca_components = pd.DataFrame((x.values - center).dot(
+            loadings.values), index=x.index)
+        self.pca_components.to_csv(path_or_buf=self.get_wd() +
+                                   OUTPUT['FILENAME_PCA'], sep=',',
+                                   header=None)
+        k = min(self.params['nn_k'], ref_pca.shape[0])
+        nn_idx, nn_dist = knn_blocked(self.pca_components.values, k,
+                                      y=ref_pca.values,
+                                      threads=self.params['threads'])
+        labels, fraction = alona.sketch.transfer_labels(nn_idx, nn_dist,
+                                                        ref_cl)
+        pos = alona.sketch.transfer_positions(nn_idx, nn_dist, ref_emb,
+                                              nn_labels=ref_cl[nn_idx],
+                                              labels=labels)
+        self.embeddings = pd.DataFrame(pos, index=x.index, columns=[1, 2])
+        self.embeddings.to_csv(path_or_buf=self.get_wd() +
+                               OUTPUT['FILENAME_EMBEDDING_PREFIX'] + method +
+                               '.csv', sep=',', header=None)
+        mapping = pd.DataFrame({'cell': x.index, 'cluster': labels,
+                                'vote_fraction': fraction,
+                                'x': pos[:, 0], 'y': pos[:, 1]})
+        fn = self.get_wd() + OUTPUT['FILENAME_REFERENCE_MAPPING']
+        mapping.to_csv(fn, sep='\t', index=False)
+        log_info('median vote fraction of the cluster assignments: %.2f' %
+                 np.median(fraction))
+        self.leiden_cl = list(labels)
+        self.leiden_prep()
+        log_debug('Exiting map_to_reference()')
+
+    def queue_plot(self, func, **kwargs):
+        """ Adds a plot to the plotting stage (see render_plots()). `func` is
+        a function of alona.plotting and `kwargs` its arguments, which
+        should only hold the arrays needed for the plot. Output files (`fn`
+        or `fns`) are given relative to the output directory, so that the
+        saved jobs can be rendered into a copy of it. """
+        self.plot_jobs.append((func, kwargs))
+
+    def _plot_jobs_in_wd(self):
+        """ Returns the plot jobs with their output files joined with the
+        output directory. """
+        wd = self.get_wd()
+        jobs = []
+        for func, kwargs in self.plot_jobs:
+            kwargs = dict(kwargs)
+            if 'fn' in kwargs:
+                kwargs['fn'] = wd + kwargs['fn']
+            if 'fns' in kwargs:
+                kwargs['fns'] = [wd + fn for fn in kwargs['fns']]
+            jobs.append((func, kwargs))
+        return jobs
+
+    def render_plots(self):
+        """ Renders the queued plots in worker processes. The plot jobs are
+        saved first, so that the plots can be rendered again with
+        `--plots_only`. """
+        log_debug('Entering render_plots()')
+        fn = self.get_wd() + OUTPUT['FILENAME_PLOT_JOBS']
+        self._dump(self.plot_jobs, fn, compress=True)
+        log_info('rendering %s plot(s)' % len(self.plot_jobs))
+        alona.plotting.render_plots(self._plot_jobs_in_wd(),
+                                    self.params['threads'])
+        self.plot_jobs = []
+        log_debug('Exiting render_plots()')
+
+    def plots_only(self):
+        """ Renders the plots saved by a previous run in the output
+        directory, without running the analysis. """
+        fn = self.get_wd() + OUTPUT['FILENAME_PLOT_JOBS']
+        if not os.path.exists(fn):
+            log_error('--plots_only: %s not found. The plots can only be \
+rendered from an output directory of a finished run.' % fn)
+        self.plot_jobs = joblib.load(fn)
+        log_info('rendering %s plot(s)' % len(self.plot_jobs))
+        alona.plotting.render_plots(self._plot_jobs_in_wd(),
+                                    self.params['threads'])
+        self.plot_jobs = []
 
     def cell_scatter_plot(self, title=''):
-        """ Generates a tSNE scatter plot with colored clusters. """
-        log_debug('Generating scatter plot...')
-        dark_bg = self.params['dark_bg']
-        method = self.params['embedding']
-        ignore_clusters = self.params['ignore_small_clusters']
+        """ Queues a scatter plot of the embedding with colored
+        clusters. """
         highlight_specific_cells = self.params['highlight_specific_cells']
         if highlight_specific_cells:
             highlight_specific_cells = re.sub(
                 ' ', '', highlight_specific_cells).split(',')
         else:
             highlight_specific_cells = []
-        if dark_bg:
-            # Don't remove this block.
-            # For some reason this block is needed for --dark_bg to function.
-            plt.clf()
-            fig = plt.figure(num=None, figsize=(5, 5))
-            fig.add_subplot(111)
-            plt.style.use('dark_background')
-            plt.scatter(1, 1, s=1)
-            plt.savefig('/tmp/_.pdf', bbox_inches='tight')
-            plt.close()
-        plt.clf()
-        fig = plt.figure()  # num=None, figsize=(5, 5)
-        grid = plt.GridSpec(nrows=1, ncols=5, hspace=0.2, wspace=0.2)
-        # python note, A:B (A=0 indexed, B=1 indexed)
-        main_ax = plt.subplot(grid[0, 0:4])
-        leg1 = plt.subplot(grid[0, -1])  # 3 is 0 indexed
-        leg1.set_xlim(0, 1)
-        leg1.set_ylim(0, 1)
-        leg1.axis('off')
-        if dark_bg:
-            log_debug('using dark background (--dark_bg is set)')
-            plt.style.use('dark_background')
-        cell_count = self.embeddings.shape[0]
-        if cell_count > 1000:
-            marker_size = 0.8
-        else:
-            marker_size = 3
-        offset = 0
-        ignored_count = 0
-        special_cells = []
-        # plot the first legend
-        for i in range(len(self.clusters_targets)):
-            idx = np.array(self.leiden_cl) == i
-            e = self.embeddings[idx]
-            col = self.cluster_colors[i]
-            if np.any(e.index.isin(highlight_specific_cells)):
-                special_cell = e[e.index.isin(highlight_specific_cells)]
-                special_cells.append({'np': special_cell,
-                                      'col': col,
-                                      'cell_id': special_cell.index.values})
-                e = e.drop(special_cell.index, axis=0)
-            x = e[1].values
-            y = e[2].values
-            if e.shape[0] <= ignore_clusters:
-                ignored_count += 1
-                continue
-            main_ax.scatter(x, y, s=marker_size, color=col,
-                            label=self.clusters_targets[i])
-            lab = i
-            rect = mpatches.Rectangle((0.05, 1-0.03*i - 0.05),
-                                      width=0.20, height=0.02,
-                                      linewidth=0, facecolor=col)
-            leg1.add_patch(rect)
-            an = leg1.annotate(lab, xy=(0.3, 1-0.03*i - 0.047), size=6)
-            renderer = fig.canvas.get_renderer()
-            bb = an.get_window_extent(renderer)
-            bbox_data = leg1.transAxes.inverted().transform(bb)
-            if bbox_data[1][0] > offset:
-                offset = bbox_data[1][0]
-
-        for special in special_cells:
-            x = special['np'][1].values
-            y = special['np'][2].values
-            col = special['col']
-            cell_id = special['cell_id']
-            main_ax.scatter(x, y, s=marker_size*2, marker='^', c=col,
-                            edgecolor='black',
-                            linewidth='0.2')
-            for i in range(0, len(x)):
-                main_ax.annotate(cell_id[i], (x[i]+1, y[i]), size=5)
-        if ignored_count:
-            log_warning('Ignoring %s cluster(s) (too few cells)' %
-                        (ignored_count))
+        predictions = None
         if self.params['species'] in ['mouse', 'human']:
-            # check cell type predictions that mismatch between the two methods
-            mismatches = {}
-            for i in range(len(self.clusters_targets)):
-                ct_method1 = self.res_pred.iloc[i][1]
-                #ct_method2 = self.res_pred2.iloc[i][0]
-                #mismatches[i] = not (ct_method1 == ct_method2)
-            # add number of cells
-            offset2 = 0
-            for i in range(len(self.clusters_targets)):
-                idx = np.array(self.leiden_cl) == i
-                e = self.embeddings[idx]
-                x = e[1].values
-                y = e[2].values
-                if e.shape[0] <= ignore_clusters:
-                    continue
-                lt = leg1.text(offset + 0.1, 1-0.03*i - 0.047, len(x), size=6)
-                renderer = fig.canvas.get_renderer()
-                bb = lt.get_window_extent(renderer)
-                bbox_data = leg1.transAxes.inverted().transform(bb)
-                if bbox_data[1][0] > offset2:
-                    offset2 = bbox_data[1][0]
-
-            # add marker-based annotation
-            offset3 = 0
-            for i in range(len(self.clusters_targets)):
-                idx = np.array(self.leiden_cl) == i
-                e = self.embeddings[idx]
-                x = e[1].values
-                y = e[2].values
-                if e.shape[0] <= ignore_clusters:
-                    continue
-                pred = self.res_pred.iloc[i]
-                ct = pred[1]
-                l = {'x': offset2 + 0.1, 'y': 1 -
-                     0.03*i - 0.047, 's': ct, 'size': 6}
-                # if mismatches[i]:
-                #    l['color'] = 'red'
-                lt = leg1.text(**l)
-                renderer = fig.canvas.get_renderer()
-                bb = lt.get_window_extent(renderer)
-                bbox_data = leg1.transAxes.inverted().transform(bb)
-                if bbox_data[1][0] > offset3:
-                    offset3 = bbox_data[1][0]
-            # add p-value
-            offset4 = 0
-            for i in range(len(self.clusters_targets)):
-                idx = np.array(self.leiden_cl) == i
-                e = self.embeddings[idx]
-                x = e[1].values
-                y = e[2].values
-                if e.shape[0] <= ignore_clusters:
-                    continue
-                pred = self.res_pred.iloc[i]
-                ct = pred[1]
-                pval = pred[2]
-                if ct == 'Unknown':
-                    pval = 'NA'
-                else:
-                    pval = '{:.1e}'.format(pval)
-                lt = leg1.text(offset3 + 0.1, 1-0.03*i - 0.047, pval, size=5)
-                renderer = fig.canvas.get_renderer()
-                bb = lt.get_window_extent(renderer)
-                bbox_data = leg1.transAxes.inverted().transform(bb)
-                if bbox_data[1][0] > offset4:
-                    offset4 = bbox_data[1][0]
-            # add SVM prediction
-            # offset5 = 0
-            # for i in range(len(self.clusters_targets)):
-                # idx = np.array(self.leiden_cl) == i
-                # e = self.embeddings[idx]
-
-                # x = e[1].values
-                # y = e[2].values
-
-                # if e.shape[0] <= ignore_clusters:
-                    # continue
-
-                # item = self.res_pred2.iloc[i]
-                # ct = item[0]
-
-                # l = {'x' : offset4 + 0.1, 'y' : 1-0.03*i - 0.047, 's' : ct, 'size' : 6}
-                # if mismatches[i]:
-                    # l['color'] = 'red'
-
-                # lt = leg1.text(**l)
-
-                # renderer = fig.canvas.get_renderer()
-                # bb = lt.get_window_extent(renderer)
-                # bbox_data = leg1.transAxes.inverted().transform(bb)
-
-                # if bbox_data[1][0] > offset5:
-                    # offset5 = bbox_data[1][0]
-
-            # add probability
-            # offset6 = 0
-            # y_offset = 0
-            # for i in range(len(self.clusters_targets)):
-                # idx = np.array(self.leiden_cl) == i
-                # e = self.embeddings[idx]
-
-                # x = e[1].values
-                # y = e[2].values
-
-                # if e.shape[0] <= ignore_clusters:
-                    # continue
-
-                # item = self.res_pred2.iloc[i]
-                # ct = item[0]
-                # prob = item[1]
-
-                # if ct == 'Unknown':
-                    # prob = 'NA'
-                # else:
-                    # prob = '{:.2f}'.format(prob)
-
-                # lt = leg1.text(offset5 + 0.1, 1-0.03*i - 0.047, prob, size=5)
-
-                # renderer = fig.canvas.get_renderer()
-                # bb = lt.get_window_extent(renderer)
-                # bbox_data = leg1.transAxes.inverted().transform(bb)
-
-                # if bbox_data[1][0] > offset6:
-                    # offset6 = bbox_data[1][0]
-
-                # y_offset = bbox_data[1][1]
-
-            # if dark_bg:
-            #    line_col = '#ffffff'
-            # else:
-            #    line_col = '#000000'
-
-            # leg1.vlines(offset4+0.05, y_offset-0.015, 1-0.03, color=line_col, clip_on=False,
-            #            lw=0.5)
-
-            # header
-            leg1.text(0.30, 0.99, 'cluster', size=5, rotation=90)
-            leg1.text(offset + 0.1, 0.99, 'no. cells', size=5, rotation=90)
-            leg1.text(offset2 + 0.1, 0.99,
-                      'marker-based\nprediction', size=5, rotation=90)
-            leg1.text(offset3 + 0.1, 0.99, 'p-value', size=5, rotation=90)
-            #leg1.text(offset4 + 0.1, 0.99, 'SVM-based\nprediction', size=5, rotation=90)
-            #leg1.text(offset5 + 0.1, 0.99, 'probability', size=5, rotation=90)
-        main_ax.set_ylabel('%s1' % method, size=6)
-        main_ax.set_xlabel('%s2' % method, size=6)
-        # smaller than default tick label size
-        main_ax.tick_params(axis='both', which='major', labelsize=5)
-        input_fn = self.params['input_filename']
-        main_ax.set_title('%s\n%s' %
-                          (title, input_fn.split('/')[-1]), fontsize=7)
-        fn = self.get_wd() + \
-            OUTPUT['FILENAME_CELL_SCATTER_PLOT_PREFIX'] + method + '.pdf'
-        if self.params['timestamp']:
-            plt.figtext(0.05, 0, get_time(), size=5)
-        plt.savefig(fn, bbox_inches='tight')
-        plt.close()
-        log_debug('Done generating scatter plot.')
+            predictions = self.res_pred[['cell type', 'p-value']].values
+        n_ignored = len(np.unique(self.leiden_cl)) - \
+            len(self.clusters_targets)
+        if n_ignored:
+            log_warning('Ignoring %s cluster(s) (too few cells)' % n_ignored)
+        method = self.params['embedding']
+        fn = OUTPUT['FILENAME_CELL_SCATTER_PLOT_PREFIX'] + method + '.pdf'
+        cells = self.cluster_order[:self.cluster_offsets[-1]]
+        self.queue_plot(alona.plotting.cell_scatter_plot, fn=fn,
+                        coordinates=self.embeddings[[1, 2]].values[cells],
+                        cell_ids=self.embeddings.index.values[cells],
+                        offsets=self.cluster_offsets,
+                        clusters_targets=self.clusters_targets,
+                        cluster_colors=self.cluster_colors,
+                        predictions=predictions,
+                        highlight=highlight_specific_cells,
+                        method=method, title=title,
+                        input_fn=self.params['input_filename'],
+                        dark_bg=self.params['dark_bg'],
+                        timestamp=self.params['timestamp'])
 
     def genes_exp_per_cluster(self, title=''):
-        """ Makes a violin plot of number of expressed genes per
+        """ Queues a violin plot of number of expressed genes per
         cluster. """
         log_debug('Entering genes_exp_per_cluster()')
-        data_norm = self.data_norm
-        cl = self.leiden_cl
-        ignore_clusters = self.params['ignore_small_clusters']
-        cluster_colors = self.cluster_colors
-        data_points = []  # array of arrays
-        labels = []
-        ticks = []
-        idx = 1
-        for i, d in data_norm.groupby(by=cl, axis=1):
-            if d.shape[1] <= ignore_clusters:
-                continue
-            genes_expressed = d.apply(lambda x: sum(x > 0), axis=0)
-            data_points.append(genes_expressed.values)
-            labels.append(i)
-            ticks.append(idx)
-            idx += 1
-        plt.clf()
-        fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(7, 5))
-        vp = ax.violinplot(data_points, showmeans=False, showmedians=True)
-        for i, part in enumerate(vp['bodies']):
-            cc = cluster_colors[i]
-            part.set_facecolor(cc)
-        ax.yaxis.grid(True)
-        ax.set_xticks(ticks)
-        ax.set_xticklabels(labels)
-        ax.set_xlabel('Cluster')
-        ax.set_ylabel('Number of expressed genes')
-        if self.params['timestamp']:
-            plt.figtext(0.05, 0, get_time(), size=5)
-        fn = self.get_wd() + OUTPUT['FILENAME_CELL_VIOLIN_GE_PLOT']
-        plt.savefig(fn, bbox_inches='tight')
+        genes_expressed = np.sum(self.data_norm.values > 0, axis=0)
+        genes_expressed = genes_expressed[self.cluster_order]
+        # array of arrays
+        data_points = np.split(genes_expressed[:self.cluster_offsets[-1]],
+                               self.cluster_offsets[1:-1])
+        fn = OUTPUT['FILENAME_CELL_VIOLIN_GE_PLOT']
+        self.queue_plot(alona.plotting.genes_exp_violin, fn=fn,
+                        data_points=data_points,
+                        labels=list(self.clusters_targets),
+                        cluster_colors=self.cluster_colors,
+                        timestamp=self.params['timestamp'])
         log_debug('Exiting genes_exp_per_cluster()')
 
     def cell_scatter_plot_w_gene_overlay(self, title=''):
-        """ Makes scatter plot(s) with overlaid gene expression on
+        """ Queues scatter plot(s) with overlaid gene expression on
         cells. """
         log_debug('Inside cell_scatter_plot_w_gene_overlay()')
         method = self.params['embedding']
         genes = self.params['overlay_genes']
-        if genes:
-            genes = re.sub(' ', '', genes).upper().split(',')
-        else:
-            genes = []
-        data_norm = self.data_norm
-        if self.params['species'] in ['mouse', 'human']:
-            symbs = pd.Series(
-                data_norm.index.str.extract('(.+)_')[0]).str.upper()
-        else:
-            symbs = pd.Series(data_norm.index.str.upper())
-        cell_count = self.embeddings.shape[0]
-        if cell_count > 1000:
-            marker_size = 0.8
-        else:
-            marker_size = 3
-        cmap = sb.cubehelix_palette(as_cmap=True)
-        for gene in genes:
-            row = data_norm.iloc[(symbs == gene).values]
-            x = self.embeddings[1].values
-            y = self.embeddings[2].values
-            plt.clf()
-            fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(7, 5))
-            #zscore = ((row-row.mean(axis=1)[0])/row.std(axis=1)[0]).values[0]
-            points = ax.scatter(x, y, s=marker_size,
-                                c=row.values[0], cmap=cmap)
-            cb = fig.colorbar(points)
-            cb.set_label('%s gene expression (log2 scale)' % (gene))
-            fn = self.get_wd() + \
-                OUTPUT['FILENAME_CELL_SCATTER_PLOT_PREFIX'] + gene + '.pdf'
-            if self.params['timestamp']:
-                plt.figtext(0.05, 0, get_time(), size=5)
-            plt.savefig(fn, bbox_inches='tight')
+        if not genes:
+            return
+        genes = re.sub(' ', '', genes).upper().split(',')
+        symbs = self.gene_symbols()
+        # first row of every gene, fetched in one slice
+        first = pd.Series(np.arange(len(symbs)), index=symbs)
+        first = first[np.logical_not(first.index.duplicated())]
+        rows = first.reindex(genes)
+        for gene in rows.index[rows.isna()]:
+            log_warning('--overlay_genes: %s was not found' % gene)
+        rows = rows.dropna().astype(int)
+        genes = list(rows.index)
+        if not genes:
+            return
+        values = self.data_norm.values[rows.values]
+        fns = [OUTPUT['FILENAME_CELL_SCATTER_PLOT_PREFIX'] + gene + '.pdf'
+               for gene in genes]
+        coordinates = self.embeddings[[1, 2]].values
+        # one figure per batch of genes, batches are rendered in parallel
+        n_batches = min(self.params['threads'], len(genes))
+        for batch in np.array_split(np.arange(len(genes)), n_batches):
+            self.queue_plot(alona.plotting.gene_overlay_plots,
+                            fns=[fns[i] for i in batch],
+                            coordinates=coordinates, values=values[batch],
+                            genes=[genes[i] for i in batch],
+                            dark_bg=self.params['dark_bg'],
+                            timestamp=self.params['timestamp'])
         log_debug('Finished cell_scatter_plot_w_gene_overlay()')
 
     def violin_top(self, title=''):
-        """ Makes violin plots of the top expressed genes per
+        """ Queues violin plots of the top expressed genes per
         cluster. """
         log_debug('Entering violin_top()')
         data_norm = self.data_norm
         n = self.params['violin_top']
-        cl = self.leiden_cl
-        ignore_clusters = self.params['ignore_small_clusters']
-        plt.clf()
-        fig_size_y = round(len(self.clusters_targets)*2)
-        fig, ax = plt.subplots(nrows=self.n_clusters,
-                               ncols=1, figsize=(7, fig_size_y))
-        fig.subplots_adjust(hspace=1)
-        idx = 0
-        for cluster_id, d in data_norm.groupby(by=cl, axis=1):
-            if d.shape[1] <= ignore_clusters:
-                continue
-            exp_mean = d.apply(lambda x: np.mean(x), axis=1)
-            top = exp_mean.sort_values(ascending=False).head(n).index
-            d_filt = d[d.index.isin(top)]
-            d_filt = d_filt.reindex(top)
-            data_points = []  # array of arrays
-            for i, row in d_filt.iterrows():
-                data_points.append(row.values)
-            vp = ax[idx].violinplot(
-                data_points, showmeans=False, showmedians=True)
-            ax[idx].grid(axis='y')
-            ax[idx].set_xticks(list(range(1, n+1)))
-            gene_labels = top
-            ax[idx].set_xticklabels(gene_labels, size=5, rotation='vertical')
-            ax[idx].set_ylabel('gene expression', size=6)
-            ax[idx].set_title('cluster %s' % cluster_id, size=6)
-            ax[idx].tick_params(axis='y', which='major', labelsize=6)
-            ax[idx].tick_params(axis='y', which='minor', labelsize=6)
-            idx += 1
-        fn = self.get_wd() + OUTPUT['FILENAME_CELL_VIOLIN_TOP']
-        if self.params['timestamp']:
-            plt.figtext(0.05, 0, get_time(), size=5)
-        plt.savefig(fn, bbox_inches='tight')
+        order, offsets = self.cluster_order, self.cluster_offsets
+        # computed once by mean_exp()
+        exp_mean = self.exp_mean
+        if exp_mean is None:
+            exp_mean = self.cluster_summary(data_norm, 'mean')
+        clusters = []
+        for k, cluster_id in enumerate(exp_mean.columns):
+            top = np.argsort(-exp_mean[cluster_id].values, kind='stable')[:n]
+            cells = order[offsets[k]:offsets[k+1]]
+            data_points = data_norm.values[np.ix_(top, cells)]
+            clusters.append((cluster_id, list(data_norm.index[top]),
+                             data_points))
+        fn = OUTPUT['FILENAME_CELL_VIOLIN_TOP']
+        self.queue_plot(alona.plotting.violin_top_plot, fn=fn,
+                        clusters=clusters, timestamp=self.params['timestamp'])
         log_debug('Finished violin_top()')
@@ -22,20 +22,30 @@ OUTPUT = {
     'FILENAME_CELL_VIOLIN_TOP': '/plots/ge_violin_top.pdf',
     'FILENAME_MARKER_HEATMAP': '/plots/marker_heatmap.png',
     'FILENAME_PCA': '/csvs/pca.csv',
+    'FILENAME_PCA_LOADINGS': '/csvs/pca_loadings.csv',
     'FILENAME_EMBEDDING_PREFIX': '/csvs/embeddings_',
     'FILENAME_HVG': '/csvs/highly_variable_genes.tsv',
     'FILENAME_ALL_T_TESTS': '/csvs/all_t_tests.csv',
     'FILENAME_ALL_T_TESTS_LONG': '/csvs/all_t_tests_long.tsv',
+    'FILENAME_ALL_T_TESTS_LONG_PARQUET': '/csvs/all_t_tests_long.parquet',
+    'FILENAME_ALL_WILCOXON_TESTS': '/csvs/all_wilcoxon_tests.csv',
+    'FILENAME_WILCOXON_ONE_VS_REST': '/csvs/wilcoxon_one_vs_rest.tsv',
     'FILENAME_MARKERS': '/csvs/discovered_markers.tsv',
-    'FILENAME_SNN_GRAPH': '/csvs/snn_graph.csv',
+    'FILENAME_SNN_PREFIX': '/snn_graph_',
     'FILENAME_CLUSTERS_LEIDEN': '/csvs/clusters_leiden.csv',
+    'FILENAME_LEIDEN_SWEEP': '/csvs/leiden_sweep.csv',
+    'FILENAME_LEIDEN_SWEEP_SUMMARY': '/csvs/leiden_sweep_summary.tsv',
     'FILENAME_MEDIAN_EXP': '/csvs/median_exp.tsv',
     'FILENAME_MEAN_EXP': '/csvs/mean_exp.tsv',
     'FILENAME_CTA_RANK_F': '/csvs/CTA_RANK_F/cell_type_pred_full_table.txt',
     'FILENAME_CTA_RANK_F_BEST': '/csvs/CTA_RANK_F/cell_type_pred_best.txt',
+    'FILENAME_CTA_PER_CELL': '/csvs/CTA_RANK_F/cell_type_pred_per_cell.tsv',
     'FILENAME_SETTINGS': '/settings.txt',
+    'FILENAME_PLOT_JOBS': '/plot_jobs.joblib',
     'FILENAME_QC_SCORE': '/csvs/Mahalanobis.csv',
-    'FILENAME_KNN_map': '/KNN.joblib'
+    'FILENAME_KNN_PREFIX': '/knn_',
+    'FILENAME_SKETCH': '/csvs/sketch_cells.csv',
+    'FILENAME_REFERENCE_MAPPING': '/csvs/reference_mapping.tsv'
 }
 
 # Reference data
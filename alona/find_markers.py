@@ -12,19 +12,35 @@
 """
 
 import sys
+from multiprocessing import shared_memory
 import joblib
 
 import numpy as np
-import statsmodels.api as sm
-import scipy.linalg
+import scipy.stats
 import pandas as pd
-import patsy
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from .log import (log_info, log_debug, log_error, log_warning)
-from .stats import p_adjust_bh
+from .stats import (p_adjust_bh, cluster_stats, pairwise_t_tests, simes,
+                    rank_sum_block, mann_whitney_tails)
 from .constants import (OUTPUT)
+from .utils import pool_context
+from .workers import (init_de_worker, wilcoxon_worker,
+                      choose_leftright_pvalues, _DE)
 from .celltypes import AlonaCellTypePred
 
+# approximate number of rows of the long table written at a time
+LONG_TABLE_BLOCK_ROWS = 1000000
+# approximate number of p-values combined at a time in combine_tests()
+SIMES_BLOCK_VALUES = 4000000
+# number of genes in one block of the Wilcoxon tests
+WILCOXON_BLOCK_GENES = 256
+# approximate number of t statistics in one block of comparisons
+T_TEST_BLOCK_VALUES = 1000000
+# smallest number of values for which the DE tests are run in worker
+# processes; below, starting the workers takes longer than the tests
+DE_PARALLEL_MIN_VALUES = 20000000
 
 class AlonaFindmarkers(AlonaCellTypePred):
     """
@@ -34,19 +50,101 @@ class AlonaFindmarkers(AlonaCellTypePred):
     def __init__(self):
         super().__init__()
 
-    def _choose_leftright_pvalues(self, left, right, direction):
-        if direction == 'up':
-            pv = right
-        elif direction == 'down':
-            pv = left
-        else:
-            pv = np.minimum(left, right)*2
-        return pv
+    @staticmethod
+    def _choose_leftright_pvalues(left, right, direction):
+        return choose_leftright_pvalues(left, right, direction)
 
     def discover_markers(self, lfc=0, direction='up'):
-        pval_mat = self.fit_lm_tt(lfc, direction)
+        if self.params['de_method'] == 'wilcoxon':
+            pval_mat = self.wilcoxon_tests(direction)
+        else:
+            pval_mat = self.fit_lm_tt(lfc, direction)
         self.combine_tests(pval_mat)
 
+    def _map_de_blocks(self, worker, x, starts, args):
+        """ Runs `worker` for every start of a block of rows of `x`. If
+        `--threads` is larger than one and `x` has at least
+        DE_PARALLEL_MIN_VALUES values, the blocks are distributed over
+        worker processes, which attach to `x` through shared memory instead
+        of receiving a copy with every block. `args` (a dict) is sent once
+        to every worker.
+
+        Returns
+        =======
+        A list with the results in the order of `starts`. """
+        workers = min(self.params['threads'], len(starts))
+        if workers <= 1 or x.size < DE_PARALLEL_MIN_VALUES:
+            _DE.update(args)
+            _DE['x'] = x
+            out = [worker(start) for start in starts]
+            _DE.clear()
+            return out
+        x = np.ascontiguousarray(x)
+        shm = shared_memory.SharedMemory(create=True, size=max(x.nbytes, 1))
+        try:
+            np.ndarray(x.shape, dtype=x.dtype, buffer=shm.buf)[...] = x
+            with pool_context().Pool(processes=workers,
+                                     initializer=init_de_worker,
+                                     initargs=(shm.name, x.shape, x.dtype.str,
+                                               args)) as pool:
+                out = pool.map(worker, starts)
+        finally:
+            shm.close()
+            shm.unlink()
+        return out
+
+    @staticmethod
+    def _comparison_labels(clusts, k_idx, i_idx):
+        """ Every pair of clusters gives the comparisons k_vs_i and
+        i_vs_k, in that order. """
+        comparisons = []
+        for k, i in zip(k_idx, i_idx):
+            comparisons.append('%s_vs_%s' % (clusts[k], clusts[i]))
+            comparisons.append('%s_vs_%s' % (clusts[i], clusts[k]))
+        return comparisons
+
+    def _de_prefilter(self, n, sums, nnz, direction):
+        """ Prefilters genes for DE analysis using per-cluster statistics
+        (see stats.cluster_stats()), before any test is run. For every
+        comparison A_vs_B, a gene passes if the fraction of cells
+        expressing it is at least `--de_min_pct` in A or in B, and if the
+        difference of the mean expression (log scale) is at least
+        `--de_min_diff` in the direction of the test (`--de_direction`).
+
+        Returns
+        =======
+        A tuple: which genes pass the comparisons k_vs_i and i_vs_k of
+        every pair (pairs x tested genes, pairs in the same order as
+        stats.pairwise_t_tests()) and which genes pass at least one
+        comparison and are therefore tested (genes). """
+        min_pct = self.params['de_min_pct']
+        min_diff = self.params['de_min_diff']
+        k_idx, i_idx = np.tril_indices(len(n), -1)
+        pass1 = np.ones((len(k_idx), sums.shape[1]), dtype=bool)
+        pass2 = pass1.copy()
+        if min_pct > 0:
+            pct = nnz/n[:, None]
+            detected = np.maximum(pct[k_idx], pct[i_idx]) >= min_pct
+            pass1 &= detected
+            pass2 &= detected
+        if min_diff > 0:
+            means = sums/n[:, None]
+            diff = means[k_idx] - means[i_idx]
+            if direction == 'up':
+                pass1 &= diff >= min_diff
+                pass2 &= -diff >= min_diff
+            elif direction == 'down':
+                pass1 &= -diff >= min_diff
+                pass2 &= diff >= min_diff
+            else:
+                pass1 &= np.abs(diff) >= min_diff
+                pass2 &= np.abs(diff) >= min_diff
+        tested = np.logical_or(pass1, pass2).any(axis=0)
+        if min_pct > 0 or min_diff > 0:
+            log_info('%s of %s genes pass the DE prefilters' %
+                     (np.sum(tested), len(tested)))
+        return pass1[:, tested], pass2[:, tested], tested
+
     def fit_lm_tt(self, lfc, direction):
         """Finds differentially expressed (DE) genes between clusters by
         fitting a linear model (LM) to gene expression (response
@@ -57,6 +155,14 @@ class AlonaFindmarkers(AlonaCellTypePred):
         DE is that computations are vectorized and therefore very
         fast.
 
+        With one coefficient per cluster the coefficients are the
+        cluster means and the standard errors of the contrasts follow
+        from the cluster sizes and the residual variance. Everything is
+        therefore computed in closed form from per-cluster sums and sums
+        of squares (see stats.cluster_stats()), without forming the
+        design matrix or the residuals, and all pairwise tests are done
+        as array operations.
+
         The ideas behind using LM to explore DE have been extensively
         covered in the limma R package.
 
@@ -72,139 +178,224 @@ class AlonaFindmarkers(AlonaCellTypePred):
         """
 
         log_debug('Entering fit_lm_tt()')
-        data_norm = self.data_norm.transpose()
-
-        leiden_cl = self.leiden_cl
-        clusters_targets = self.clusters_targets
-
-        # remove clusters with too few cells
-        data_norm = data_norm[np.isin(leiden_cl, clusters_targets)]
-        leiden_cl = np.array(leiden_cl)[np.isin(leiden_cl, clusters_targets)]
-
-        # full design matrix
-        dm_full = patsy.dmatrix('~ 0 + C(cl)', pd.DataFrame({'cl': leiden_cl}))
-        resid_df = dm_full.shape[0] - dm_full.shape[1]
-
-        # gene expression should be the response
-        lm = sm.regression.linear_model.OLS(endog=data_norm,  # response
-                                            exog=dm_full)  # design matrix
-        res = lm.fit()
-        coef = res.params  # coefficients
-
-        # computing standard errors
-        # https://stats.stackexchange.com/questions/44838/how-are-the-standard-errors-of-coefficients-calculated-in-a-regression
-        # http://web.mit.edu/~r/current/arch/i386_linux26/lib/R/library/limma/html/lm.series.html
-        # residual variance for each gene
-        dm_nrow = dm_full.shape[0]
-        dm_ncol = dm_full.shape[1]
-        sigma2 = ((data_norm-dm_full.dot(coef)) **
-                  2).sum(axis=0)/(dm_nrow-dm_ncol)
-
-        q = dm_full.transpose().dot(dm_full)
-        chol = np.linalg.cholesky(q)
-        chol2inv = scipy.linalg.cho_solve((chol, False), np.eye(chol.shape[0]))
-        std_dev = np.sqrt(np.diag(chol2inv))
-        clusts = np.unique(leiden_cl)
-
-        # mean gene expression for every gene in every cluster
-        mge = [data_norm.iloc[leiden_cl == cl, :].mean()
-               for cl in np.unique(leiden_cl)]
-
-        # perform all pairwise comparisons of clusters (t-tests)
-        comparisons = []
-        out_t_stats = []
-        out_pv = []
-        out_lfc = []
-        out_mge_g1 = []
-        out_mge_g2 = []
+        genes = self.data_norm.index
+
+        # clusters with too few cells are collected in an extra cluster,
+        # which is dropped
+        clusts, codes = self._cluster_codes()
+        n, sums, sumsq, nnz = cluster_stats(self.data_norm.values, codes,
+                                            len(clusts)+1)
+        n, sums, sumsq, nnz = n[:-1], sums[:-1], sumsq[:-1], nnz[:-1]
+        pass1, pass2, tested = self._de_prefilter(n, sums, nnz, direction)
+        genes = genes[tested]
+        k_idx, i_idx, mge, cur_lfc, cur_t, resid_df = pairwise_t_tests(
+            n, sums[:, tested], sumsq[:, tested])
+
+        # compute p-values in blocks of comparisons; this is cheap compared
+        # with the Wilcoxon tests and not worth worker processes
+        pv1 = np.empty(cur_t.shape)
+        pv2 = np.empty(cur_t.shape)
+        t_dist = scipy.stats.t(resid_df)
+        block = max(1, T_TEST_BLOCK_VALUES//max(1, len(genes)))
+        for start in range(0, len(k_idx), block):
+            t_stat = cur_t[start:start+block]
+            left = t_dist.cdf(t_stat)
+            right = t_dist.sf(t_stat)
+            pv1[start:start+block] = self._choose_leftright_pvalues(
+                left, right, direction)
+            pv2[start:start+block] = self._choose_leftright_pvalues(
+                right, left, direction)
+        pv1[np.logical_not(pass1)] = 1
+        pv2[np.logical_not(pass2)] = 1
+
+        comparisons = self._comparison_labels(clusts, k_idx, i_idx)
+        out_pv = np.stack((pv1, pv2), axis=1).reshape(-1, len(genes))
+        out_merged = pd.DataFrame(out_pv.T, index=genes, columns=comparisons)
 
-        for k, _ in enumerate(clusts):
-            ref_coef = coef.iloc[k, :]
-            # recompute coefficients for contrasts
-            # https://genomicsclass.github.io/book/pages/interactions_and_contrasts.html
-            con = np.zeros((coef.shape[0], k))
-            np.fill_diagonal(con, -1)
-            con[k, ] = 1
-
-            std_new = np.sqrt((std_dev**2).dot(con**2))
-
-            for i in np.arange(k):
-                std_err = std_new[i]**2*sigma2
-                target_cl = clusts[i]
-
-                # log2 fold change, reminder: log2(A/B)=log2(A)-log2(B)
-                cur_lfc = ref_coef - coef.iloc[i, :]
-                cur_lfc.index = std_err.index
-
-                # compute p-values
-                if lfc == 0:
-                    cur_t = cur_lfc/np.sqrt(std_err)
-                    t_dist = scipy.stats.t(resid_df)
-
-                    left = t_dist.cdf(cur_t)
-                    right = t_dist.sf(cur_t)
+        fn = self.get_wd() + OUTPUT['FILENAME_ALL_T_TESTS']
+        out_merged.to_csv(fn, sep=',')
 
-                    pv1 = self._choose_leftright_pvalues(
-                        left, right, direction)
-                    pv2 = self._choose_leftright_pvalues(
-                        right, left, direction)
+        self.write_t_tests_long(genes, comparisons, k_idx, i_idx, pv1, pv2,
+                                cur_t, cur_lfc, mge)
 
-                comparisons.append('%s_vs_%s' % (clusts[k], clusts[i]))
-                comparisons.append('%s_vs_%s' % (clusts[i], clusts[k]))
+        log_debug('Exiting fit_lm_tt()')
+        return out_merged
 
-                out_pv.append(pd.Series(pv1))
-                out_pv.append(pd.Series(pv2))
+    def wilcoxon_tests(self, direction):
+        """ Finds differentially expressed genes between clusters with the
+        Wilcoxon rank-sum (Mann-Whitney U) test, a nonparametric
+        alternative to fit_lm_tt().
 
-                out_t_stats.append(pd.Series(cur_t))
-                out_t_stats.append(pd.Series(cur_t))
+        The values of every gene are sorted once across all cells; for
+        sparse data the zeros are handled as one group of tied values
+        without sorting them. U statistics of all pairs of clusters are
+        derived from the counts of every cluster in every group of tied
+        values (see stats.rank_sum_block()), and one-vs-rest statistics
+        are sums over the pairs. P-values use the normal approximation
+        with tie and continuity correction. Genes are processed in blocks,
+        in parallel worker processes if `--threads` is larger than one.
 
-                out_lfc.append(pd.Series(cur_lfc))
-                out_lfc.append(pd.Series(cur_lfc*-1))
+        The pairwise p-values are written in the same layout as
+        all_t_tests.csv and the one-vs-rest results (U, AUC, p-value and
+        FDR) to a separate table.
 
-                out_mge_g1.append(mge[k])
-                out_mge_g2.append(mge[i])
+        Arguments
+        =========
+        direction : Can be 'any' for any direction 'up' for up-regulated and
+        'down' for down-regulated.
 
-                out_mge_g1.append(mge[i])
-                out_mge_g2.append(mge[k])
+        Returns
+        =======
+        A data frame with the p-values of the pairwise comparisons. """
+        log_debug('Entering wilcoxon_tests()')
+        genes = self.data_norm.index
+        x = self.data_norm.values
+        clusts, codes = self._cluster_codes()
+        n_clusters = len(clusts)
+        n, sums, _, nnz = cluster_stats(x, codes, n_clusters+1)
+        pass1, pass2, tested = self._de_prefilter(n[:-1], sums[:-1],
+                                                  nnz[:-1], direction)
+        if not tested.all():
+            genes = genes[tested]
+            x = x[tested]
+        k_idx, i_idx = np.tril_indices(n_clusters, -1)
+        comparisons = self._comparison_labels(clusts, k_idx, i_idx)
+        out_pv = np.empty((len(genes), len(comparisons)))
+        ovr_u = np.empty((len(genes), n_clusters))
+        ovr_pv = np.empty((len(genes), n_clusters))
+        n = np.bincount(codes[codes < n_clusters], minlength=n_clusters)
+        n_rest = n.sum() - n
+
+        starts = list(range(0, len(genes), WILCOXON_BLOCK_GENES))
+        out = self._map_de_blocks(wilcoxon_worker, x, starts,
+                                  {'block': WILCOXON_BLOCK_GENES,
+                                   'codes': codes, 'n_clusters': n_clusters,
+                                   'direction': direction})
+        for start, (pv, u_rest, pv_rest) in zip(starts, out):
+            end = start + len(pv)
+            out_pv[start:end, 0::2] = np.where(pass1[:, start:end].T,
+                                               pv[:, k_idx, i_idx], 1)
+            out_pv[start:end, 1::2] = np.where(pass2[:, start:end].T,
+                                               pv[:, i_idx, k_idx], 1)
+            ovr_u[start:end] = u_rest
+            ovr_pv[start:end] = pv_rest
+
+        out_merged = pd.DataFrame(out_pv, index=genes, columns=comparisons)
+        fn = self.get_wd() + OUTPUT['FILENAME_ALL_WILCOXON_TESTS']
+        out_merged.to_csv(fn, sep=',')
 
-        out_merged = pd.concat(out_pv, axis=1)
-        out_merged.columns = comparisons
-        out_merged.index = data_norm.columns
+        pval = ovr_pv.T.ravel()
+        ovr = pd.DataFrame({'cluster': np.repeat(clusts, len(genes)),
+                            'gene': np.tile(genes, n_clusters),
+                            'U': ovr_u.T.ravel(),
+                            'AUC': (ovr_u/(n*n_rest)).T.ravel(),
+                            'p_val': pval,
+                            'FDR': p_adjust_bh(pval)})
+        fn = self.get_wd() + OUTPUT['FILENAME_WILCOXON_ONE_VS_REST']
+        ovr.to_csv(fn, sep='\t', index=False)
+        log_debug('Exiting wilcoxon_tests()')
+        return out_merged
 
-        fn = self.get_wd() + OUTPUT['FILENAME_ALL_T_TESTS']
-        out_merged.to_csv(fn, sep=',')
+    def write_t_tests_long(self, genes, comparisons, k_idx, i_idx, pv1, pv2,
+                           t_stat, lfc, mge):
+        """ Writes the results of all pairwise comparisons as a long table
+        (one row per comparison and gene). The table is written one block
+        of comparisons at a time and never held in memory as a whole.
 
-        lab1 = []
-        lab2 = []
-        anno = []
-
-        for q in comparisons:
-            lab1.append(pd.Series([q]*data_norm.columns.shape[0]))
-            lab2.append(pd.Series(data_norm.columns))
-            if type(self.anno) == pd.core.frame.DataFrame:
-                anno.append(self.anno['desc'])
-
-        pval = pd.concat(out_pv, ignore_index=True)
-        ll = pd.DataFrame({'comparison_A_vs_B': pd.concat(lab1, ignore_index=True),
-                           'gene': pd.concat(lab2, ignore_index=True),
-                           'p_val': pval,
-                           'FDR': p_adjust_bh(pval),
-                           't_stat': pd.concat(out_t_stats, ignore_index=True),
-                           'logFC': pd.concat(out_lfc, ignore_index=True),
-                           'mean.A': pd.concat(out_mge_g1, ignore_index=True),
-                           'mean.B': pd.concat(out_mge_g2, ignore_index=True)})
-        if anno:
-            ll['annotation'] = pd.concat(anno, ignore_index=True)
-
-        fn = self.get_wd() + OUTPUT['FILENAME_ALL_T_TESTS_LONG']
-        ll.to_csv(fn, sep='\t', index=False)
+        The default format is parquet, where comparison, gene and
+        annotation are dictionary encoded (categorical) columns. If
+        `--de_long_format` is tsv, a tab separated text file is written
+        instead. FDR is computed over all p-values before writing.
 
-        log_debug('Exiting fit_lm_tt()')
-        return out_merged
+        Arguments
+        =========
+        genes : Gene identifiers.
+        comparisons : Comparison labels, two per pair (k_vs_i, i_vs_k).
+        k_idx, i_idx : Cluster indices of the pairs.
+        pv1, pv2 : P-values of k_vs_i and i_vs_k (pairs x genes).
+        t_stat : t-statistics (pairs x genes).
+        lfc : Mean of cluster k minus mean of cluster i (pairs x genes).
+        mge : Mean expression of every cluster (clusters x genes). """
+        log_debug('Entering write_t_tests_long()')
+        n_genes = len(genes)
+        fdr = p_adjust_bh(np.stack((pv1, pv2), axis=1).ravel())
+        fdr = fdr.reshape(len(k_idx), 2, n_genes)
+        anno = None
+        if type(self.anno) == pd.core.frame.DataFrame:
+            anno = self.anno['desc'].reindex(genes).values
+        use_tsv = self.params['de_long_format'] == 'tsv'
+        if use_tsv:
+            fn = self.get_wd() + OUTPUT['FILENAME_ALL_T_TESTS_LONG']
+        else:
+            fn = self.get_wd() + OUTPUT['FILENAME_ALL_T_TESTS_LONG_PARQUET']
+            comparison_dict = pa.array(comparisons, type=pa.string())
+            gene_dict = pa.array([str(g) for g in genes], type=pa.string())
+            fields = [('comparison_A_vs_B', pa.dictionary(pa.int32(),
+                                                          pa.string())),
+                      ('gene', pa.dictionary(pa.int32(), pa.string()))]
+            fields += [(c, pa.float64()) for c in ('p_val', 'FDR', 't_stat',
+                                                   'logFC', 'mean.A',
+                                                   'mean.B')]
+            if anno is not None:
+                anno_codes, anno_dict = pd.factorize(anno)
+                anno_dict = pa.array(anno_dict.astype(str), type=pa.string())
+                fields.append(('annotation', pa.dictionary(pa.int32(),
+                                                           pa.string())))
+            writer = pq.ParquetWriter(fn, pa.schema(fields))
+        # number of pairs per block, every pair gives two comparisons
+        step = max(1, LONG_TABLE_BLOCK_ROWS//(2*n_genes))
+        for start in range(0, len(k_idx), step):
+            end = min(start + step, len(k_idx))
+            k = k_idx[start:end]
+            i = i_idx[start:end]
+            n_comp = 2*(end-start)
+            columns = {
+                'p_val': np.stack((pv1[start:end], pv2[start:end]), axis=1),
+                'FDR': fdr[start:end],
+                't_stat': np.stack((t_stat[start:end], t_stat[start:end]),
+                                   axis=1),
+                'logFC': np.stack((lfc[start:end], -lfc[start:end]), axis=1),
+                'mean.A': np.stack((mge[k], mge[i]), axis=1),
+                'mean.B': np.stack((mge[i], mge[k]), axis=1)}
+            columns = {c: columns[c].ravel() for c in columns}
+            if use_tsv:
+                block = pd.DataFrame(columns)
+                block.insert(0, 'comparison_A_vs_B',
+                             np.repeat(comparisons[2*start:2*end], n_genes))
+                block.insert(1, 'gene', np.tile(genes, n_comp))
+                if anno is not None:
+                    block['annotation'] = np.tile(anno, n_comp)
+                block.to_csv(fn, sep='\t', index=False,
+                             mode='w' if start == 0 else 'a',
+                             header=start == 0)
+            else:
+                comp_codes = np.repeat(np.arange(2*start, 2*end,
+                                                 dtype=np.int32), n_genes)
+                gene_codes = np.tile(np.arange(n_genes, dtype=np.int32),
+                                     n_comp)
+                arrays = [
+                    pa.DictionaryArray.from_arrays(comp_codes,
+                                                   comparison_dict),
+                    pa.DictionaryArray.from_arrays(gene_codes, gene_dict)]
+                arrays += [pa.array(columns[c]) for c in columns]
+                if anno is not None:
+                    arrays.append(pa.DictionaryArray.from_arrays(
+                        np.tile(anno_codes.astype(np.int32), n_comp),
+                        anno_dict))
+                writer.write_table(pa.Table.from_arrays(
+                    arrays, schema=writer.schema))
+        if not use_tsv:
+            writer.close()
+        log_debug('Exiting write_t_tests_long()')
 
     def combine_tests(self, pval_mat):
         """Uses Simes' method for combining p-values.
 
+        The p-values of every cluster (columns `<cluster>_vs_<other>`)
+        are gathered into a genes x clusters x comparisons array, using
+        the column names parsed once, and combined for all clusters at
+        once, in blocks of genes.
+
         Arguments
         =========
         pval_mat : A data frame with p-values.
@@ -214,21 +405,43 @@ class AlonaFindmarkers(AlonaCellTypePred):
 
         """
 
-        test_mat = pval_mat
         clusters_targets = self.clusters_targets
-
-        res = []
-        for cl in clusters_targets:
-            idx = test_mat.columns.str.match('^%s_vs' % cl)
-            subset_mat = test_mat.iloc[:, idx]
-
-            r = subset_mat.rank(axis=1)
-            T = (subset_mat.shape[1]*subset_mat/r).min(axis=1).sort_values()
-            T[T > 1] = 1
-
-            df = pd.DataFrame(
-                {'cluster': [cl]*len(T), 'gene': T.index, 'pvalue.Simes': T})
-            res.append(df)
+        genes = pval_mat.index
+        # columns of every cluster, from the first cluster in the names
+        target_pos = {str(cl): i for i, cl in enumerate(clusters_targets)}
+        cols = [[] for _ in clusters_targets]
+        for j, name in enumerate(pval_mat.columns):
+            i = target_pos.get(str(name).split('_vs_')[0])
+            if i is not None:
+                cols[i].append(j)
+        n_tests = np.array([len(c) for c in cols])
+        # gather index (clusters x comparisons), padded with a column of NaN
+        values = np.column_stack((pval_mat.values.astype(np.float64),
+                                  np.full(len(genes), np.nan)))
+        width = max(n_tests.max(), 1)
+        gather = np.full((len(cols), width), values.shape[1]-1)
+        for i, c in enumerate(cols):
+            gather[i, :len(c)] = c
+        T = np.empty((len(genes), len(cols)))
+        block = max(1, SIMES_BLOCK_VALUES//gather.size)
+        for start in range(0, len(genes), block):
+            end = min(start + block, len(genes))
+            T[start:end] = simes(values[start:end][:, gather], n_tests)
+
+        # sort every cluster by combined p-value, NaN last, in the same
+        # order as pandas' sort_values() (quicksort of the non-NaN values)
+        order = np.argsort(T, axis=0)
+        for i in np.flatnonzero(np.isnan(T).any(axis=0)):
+            nan = np.isnan(T[:, i])
+            ok = np.flatnonzero(np.logical_not(nan))
+            order[:, i] = np.concatenate((ok[np.argsort(T[ok, i])],
+                                          np.flatnonzero(nan)))
+        T = np.take_along_axis(T, order, axis=0)
+        T[T > 1] = 1
+        res = pd.DataFrame({
+            'cluster': np.repeat(clusters_targets, len(genes)),
+            'gene': np.asarray(genes)[order].ravel(order='F'),
+            'pvalue.Simes': T.ravel(order='F')})
 
         fn = self.get_wd() + OUTPUT['FILENAME_MARKERS']
-        pd.concat(res).to_csv(fn, sep='\t', index=False)
+        res.to_csv(fn, sep='\t', index=False)
@@ -1,6 +1,5 @@
 import numpy as np
 import scipy.stats as sts
-import patsy as pt
 
 from .utils import (check_types, check_commensurate, check_intercept,
                     check_offset, check_sample_weights, has_converged,
@@ -155,6 +154,8 @@ class GLM:
         """
         check_types(X, y, formula) 
         if formula:
+            # patsy is only needed for model formulas, which alona does not use
+            import patsy as pt
             self.formula = formula
             y_array, X_array = pt.dmatrices(formula, X)
             self.X_info = X_array.design_info
@@ -254,6 +255,7 @@ class GLM:
             raise ValueError(
                 "Model is not fit, and cannot be used to make predictions.")
         if self.formula:
+            import patsy as pt
             rhs_formula = '+'.join(self.X_info.term_names[1:])
             X = pt.dmatrix(rhs_formula, X)
         if offset is None:
@@ -0,0 +1,170 @@
+""" alona
+
+ Description: Exact nearest neighbour search used by alona.
+
+ How to use: https://github.com/oscar-franzen/alona/
+
+ Contact: Oscar Franzen <p.oscar.franzen@gmail.com> """
+
+import glob
+import hashlib
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Number of rows/columns in one distance block. 1024 x 1024 doubles is 8 MB,
+# which together with the operands stays within a typical L2/L3 cache.
+BLOCK_SIZE = 1024
+
+
+def _knn_row_block(x_block, x_sq, y, y_sq, k, offset, query_is_ref, block_size):
+    """ Finds the k nearest neighbours of the rows in `x_block` among the
+    rows of `y`. Squared Euclidean distances are computed one column block at
+    a time as ||x||^2 + ||y||^2 - 2xy' and a running top-k is kept per row. """
+    n_rows = x_block.shape[0]
+    n_ref = y.shape[0]
+    best_idx = np.empty((n_rows, 0), dtype=np.int64)
+    best_dist = np.empty((n_rows, 0), dtype=x_block.dtype)
+    rows = np.arange(n_rows)
+    for start in range(0, n_ref, block_size):
+        end = min(start + block_size, n_ref)
+        d = np.dot(x_block, y[start:end].T)
+        d *= -2
+        d += x_sq[:, None]
+        d += y_sq[None, start:end]
+        # rounding can produce tiny negative values
+        np.maximum(d, 0, out=d)
+        if query_is_ref:
+            # the query rows are part of the reference set, the distance of a
+            # point to itself is zero by definition
+            self_col = rows + offset - start
+            ok = (self_col >= 0) & (self_col < end - start)
+            d[rows[ok], self_col[ok]] = 0
+        cand_idx = np.concatenate(
+            (best_idx, np.broadcast_to(np.arange(start, end),
+                                       (n_rows, end - start))), axis=1)
+        cand_dist = np.concatenate((best_dist, d), axis=1)
+        if cand_dist.shape[1] > k:
+            part = np.argpartition(cand_dist, k - 1, axis=1)[:, :k]
+            best_idx = np.take_along_axis(cand_idx, part, axis=1)
+            best_dist = np.take_along_axis(cand_dist, part, axis=1)
+        else:
+            best_idx = cand_idx
+            best_dist = cand_dist
+    # order the neighbours of every row by increasing distance
+    o = np.argsort(best_dist, axis=1, kind='stable')
+    best_idx = np.take_along_axis(best_idx, o, axis=1)
+    best_dist = np.take_along_axis(best_dist, o, axis=1)
+    return best_idx, np.sqrt(best_dist)
+
+
+def knn_blocked(x, k, y=None, block_size=BLOCK_SIZE, threads=1):
+    """ Exact k nearest neighbour search using blocked matrix
+    multiplication.
+
+    For moderate dimensions (e.g. 75 principal components) computing all
+    distances with BLAS is faster than tree based methods, which degrade to
+    brute force in high dimensions anyway. Blocks of query rows are
+    distributed over a thread pool; numpy releases the GIL during the matrix
+    products and the selection.
+
+    Arguments
+    =========
+    x : Query points (n x d).
+    k : Number of neighbours to find.
+    y : Reference points (m x d). If None, the query points are searched
+        against themselves and every point is its own first neighbour (same
+        as sklearn's `kneighbors()` without arguments on the fitted data).
+    block_size : Number of rows and columns in one distance block.
+    threads : Number of threads.
+
+    Returns
+    =======
+    A tuple of two n x k arrays: zero-based indices of the neighbours in `y`
+    and the corresponding Euclidean distances, ordered by increasing
+    distance. """
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    query_is_ref = y is None
+    if query_is_ref:
+        y = x
+    else:
+        y = np.ascontiguousarray(y, dtype=np.float64)
+    if k > y.shape[0]:
+        raise ValueError('k (%s) cannot be larger than the number of \
+reference points (%s)' % (k, y.shape[0]))
+    x_sq = np.einsum('ij,ij->i', x, x)
+    y_sq = x_sq if query_is_ref else np.einsum('ij,ij->i', y, y)
+    starts = list(range(0, x.shape[0], block_size))
+
+    def _job(start):
+        end = min(start + block_size, x.shape[0])
+        return _knn_row_block(x[start:end], x_sq[start:end], y, y_sq, k,
+                              start, query_is_ref, block_size)
+
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            res = list(pool.map(_job, starts))
+    else:
+        res = [_job(start) for start in starts]
+    indices = np.concatenate([r[0] for r in res])
+    distances = np.concatenate([r[1] for r in res])
+    return indices, distances
+
+
+def knn_cache_key(x, index=None, decimals=6):
+    """ Returns a key identifying the input of a neighbour search. The
+    values are rounded so that the key is the same for principal components
+    that have been written to and read back from a text file. """
+    x = np.ascontiguousarray(np.round(np.asarray(x, dtype=np.float64),
+                                      decimals))
+    # -0.0 and 0.0 have different byte representations
+    x += 0.0
+    h = hashlib.sha1()
+    h.update(str(x.shape).encode())
+    h.update(x.tobytes())
+    if index is not None:
+        h.update('\t'.join(map(str, index)).encode())
+    return h.hexdigest()[:16]
+
+
+def _knn_cache_files(prefix, key, k):
+    return ('%s%s_k%s_idx.npy' % (prefix, key, k),
+            '%s%s_k%s_dist.npy' % (prefix, key, k))
+
+
+def save_knn(prefix, key, indices, distances):
+    """ Stores a neighbour search result as int32 indices and float32
+    distances in numpy's binary format, which can be memory-mapped. """
+    fn_idx, fn_dist = _knn_cache_files(prefix, key, indices.shape[1])
+    np.save(fn_idx, indices.astype(np.int32))
+    np.save(fn_dist, distances.astype(np.float32))
+
+
+def load_knn(prefix, key, k):
+    """ Looks for a stored neighbour search of the same input with at least
+    k neighbours. The files are memory-mapped and only the first k columns
+    are returned, neighbours being ordered by distance.
+
+    Returns
+    =======
+    A tuple (indices, distances) or None if no usable result exists. """
+    pattern = re.compile(re.escape(os.path.basename(prefix + key)) +
+                         r'_k(\d+)_idx\.npy$')
+    best = None
+    for fn in glob.glob(glob.escape(prefix + key) + '_k*_idx.npy'):
+        m = pattern.search(fn)
+        if not m:
+            continue
+        stored_k = int(m.group(1))
+        if stored_k >= k and (best is None or stored_k < best):
+            best = stored_k
+    if best is None:
+        return None
+    fn_idx, fn_dist = _knn_cache_files(prefix, key, best)
+    if not os.path.exists(fn_dist):
+        return None
+    indices = np.load(fn_idx, mmap_mode='r')
+    distances = np.load(fn_dist, mmap_mode='r')
+    return indices[:, :k], distances[:, :k]
@@ -0,0 +1,381 @@
+""" alona
+
+ Description: Plots of the analysis results.
+
+ The plots are rendered in a separate stage at the end of the analysis.
+ Every plot is a job, a plotting function and the arrays it needs, and the
+ jobs are independent of each other and of the analysis objects. They are
+ rendered in worker processes with the Agg backend and the jobs are saved
+ in the output directory, so that the plots can be rendered again without
+ rerunning the analysis (`--plots_only`).
+
+ How to use: https://github.com/oscar-franzen/alona/
+
+ Contact: Oscar Franzen <p.oscar.franzen@gmail.com> """
+
+import numpy as np
+import matplotlib.pyplot as plt
+import matplotlib.patches as mpatches
+import matplotlib.transforms as transforms
+import seaborn as sb
+
+from .log import log_debug
+from .utils import (get_time, pool_context)
+
+# scatter plots of more cells than this are drawn as an image inside the
+# (vector) PDF; axes, legends and labels stay vector graphics
+RASTERIZE_CELLS = 5000
+# resolution of the rasterized scatter layers
+RASTER_DPI = 300
+# smallest number of data values of all plots for which the plots are
+# rendered in worker processes
+PLOT_PARALLEL_MIN_VALUES = 1000000
+
+
+def bin_columns(x, counts, n_bins):
+    """ Averages consecutive columns of `x` into at most about `n_bins`
+    columns, e.g. the cells of a heatmap into the pixel columns of the
+    image. The columns form groups of `counts` columns (the cells of every
+    cluster); every group gets a number of bins proportional to its size
+    but at least one, and bins do not cross groups.
+
+    Arguments
+    =========
+    x : A genes x cells array, cells ordered by group.
+    counts : Number of columns in every group.
+    n_bins : The requested number of bins.
+
+    Returns
+    =======
+    A tuple: the binned array and the number of bins of every group. """
+    counts = np.asarray(counts)
+    n_cols = counts.sum()
+    if n_cols <= n_bins:
+        return x, counts
+    bins = np.minimum(counts, np.maximum(
+        1, np.floor(counts/n_cols*n_bins).astype(int)))
+    starts = []
+    offset = 0
+    for count, n in zip(counts, bins):
+        starts.append(offset + np.arange(n)*count//n)
+        offset += count
+    starts = np.concatenate(starts)
+    widths = np.diff(np.append(starts, n_cols))
+    return np.add.reduceat(x, starts, axis=1)/widths, bins
+
+
+def _marker_size(cell_count):
+    if cell_count > 1000:
+        return 0.8
+    return 3
+
+
+def _rasterize(cell_count):
+    """ One marker per cell makes PDFs of large data sets slow to write and
+    to open; the markers are rasterized above RASTERIZE_CELLS cells. """
+    return cell_count > RASTERIZE_CELLS
+
+
+def _legend_column(ax, x, labels, size, renderer):
+    """ Writes one column of the legend, one row per cluster, at `x` (axes
+    coordinates) and returns the right edge of the widest label. """
+    right = x
+    for row, label in enumerate(labels):
+        lt = ax.text(x, 1-0.03*row - 0.047, label, size=size)
+        bb = lt.get_window_extent(renderer)
+        right = max(right, ax.transAxes.inverted().transform(bb)[1][0])
+    return right
+
+
+def cell_scatter_plot(fn, coordinates, cell_ids, offsets, clusters_targets,
+                      cluster_colors, predictions=None, highlight=(),
+                      method='tSNE', title='', input_fn='', dark_bg=False,
+                      timestamp=False):
+    """ Generates a scatter plot of the embedding with colored clusters and
+    a legend with the number of cells and the cell type prediction of every
+    cluster.
+
+    Arguments
+    =========
+    fn : Output file.
+    coordinates : The embedding (n x 2), cells sorted by cluster.
+    cell_ids : Identifiers of the cells.
+    offsets : The cells of clusters_targets[k] are the rows
+        offsets[k]:offsets[k+1].
+    clusters_targets : The clusters.
+    cluster_colors : Color of every cluster.
+    predictions : Cell type and p-value of every cluster (n_clusters x 2),
+        or None to leave out the predictions.
+    highlight : Identifiers of cells to highlight.
+    dark_bg : Use a dark background. """
+    log_debug('Generating scatter plot...')
+    style = 'dark_background' if dark_bg else 'default'
+    with plt.style.context(style):
+        fig = plt.figure()  # num=None, figsize=(5, 5)
+        grid = plt.GridSpec(nrows=1, ncols=5, hspace=0.2, wspace=0.2)
+        # python note, A:B (A=0 indexed, B=1 indexed)
+        main_ax = plt.subplot(grid[0, 0:4])
+        leg1 = plt.subplot(grid[0, -1])  # 3 is 0 indexed
+        leg1.set_xlim(0, 1)
+        leg1.set_ylim(0, 1)
+        leg1.axis('off')
+        marker_size = _marker_size(coordinates.shape[0])
+        rasterized = _rasterize(coordinates.shape[0])
+        special = np.isin(cell_ids, highlight)
+        for k, cluster in enumerate(clusters_targets):
+            lo, hi = offsets[k], offsets[k+1]
+            xy = coordinates[lo:hi][np.logical_not(special[lo:hi])]
+            col = cluster_colors[k]
+            main_ax.scatter(xy[:, 0], xy[:, 1], s=marker_size, color=col,
+                            label=cluster, rasterized=rasterized)
+            rect = mpatches.Rectangle((0.05, 1-0.03*k - 0.05),
+                                      width=0.20, height=0.02,
+                                      linewidth=0, facecolor=col)
+            leg1.add_patch(rect)
+        # highlighted cells on top of all clusters
+        for k in range(len(clusters_targets)):
+            lo, hi = offsets[k], offsets[k+1]
+            rows = lo + np.flatnonzero(special[lo:hi])
+            if len(rows) == 0:
+                continue
+            x = coordinates[rows, 0]
+            y = coordinates[rows, 1]
+            main_ax.scatter(x, y, s=marker_size*2, marker='^',
+                            c=cluster_colors[k], edgecolor='black',
+                            linewidth=0.2)
+            for i, cell_id in enumerate(cell_ids[rows]):
+                main_ax.annotate(cell_id, (x[i]+1, y[i]), size=5)
+        # legend columns, each placed after the widest label of the
+        # previous column
+        renderer = fig.canvas.get_renderer()
+        offset = _legend_column(leg1, 0.3, clusters_targets, 6, renderer)
+        if predictions is not None:
+            # add number of cells
+            offset2 = _legend_column(leg1, offset + 0.1, np.diff(offsets), 6,
+                                     renderer)
+            # add marker-based annotation
+            offset3 = _legend_column(leg1, offset2 + 0.1, predictions[:, 0],
+                                     6, renderer)
+            # add p-value
+            for i, (ct, pval) in enumerate(predictions):
+                if ct == 'Unknown':
+                    pval = 'NA'
+                else:
+                    pval = '{:.1e}'.format(pval)
+                leg1.text(offset3 + 0.1, 1-0.03*i - 0.047, pval, size=5)
+            # header
+            leg1.text(0.30, 0.99, 'cluster', size=5, rotation=90)
+            leg1.text(offset + 0.1, 0.99, 'no. cells', size=5, rotation=90)
+            leg1.text(offset2 + 0.1, 0.99,
+                      'marker-based\nprediction', size=5, rotation=90)
+            leg1.text(offset3 + 0.1, 0.99, 'p-value', size=5, rotation=90)
+        main_ax.set_ylabel('%s1' % method, size=6)
+        main_ax.set_xlabel('%s2' % method, size=6)
+        # smaller than default tick label size
+        main_ax.tick_params(axis='both', which='major', labelsize=5)
+        main_ax.set_title('%s\n%s' %
+                          (title, input_fn.split('/')[-1]), fontsize=7)
+        if timestamp:
+            plt.figtext(0.05, 0, get_time(), size=5)
+        plt.savefig(fn, bbox_inches='tight', dpi=RASTER_DPI)
+        plt.close()
+    log_debug('Done generating scatter plot.')
+
+
+def gene_overlay_plots(fns, coordinates, values, genes, dark_bg=False,
+                       timestamp=False):
+    """ Makes scatter plots of the embedding (n x 2) with the expression of
+    genes overlaid on the cells. One figure is drawn and only the colors,
+    the color scale and the label change from gene to gene.
+
+    Arguments
+    =========
+    fns : Output file of every gene.
+    coordinates : The embedding (n x 2).
+    values : Expression of the genes (genes x n).
+    genes : The gene symbols. """
+    style = 'dark_background' if dark_bg else 'default'
+    with plt.style.context(style):
+        cmap = sb.cubehelix_palette(as_cmap=True)
+        fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(7, 5))
+        points = ax.scatter(coordinates[:, 0], coordinates[:, 1],
+                            s=_marker_size(coordinates.shape[0]),
+                            c=values[0], cmap=cmap,
+                            rasterized=_rasterize(coordinates.shape[0]))
+        cb = fig.colorbar(points)
+        if timestamp:
+            plt.figtext(0.05, 0, get_time(), size=5)
+        for fn, gene, v in zip(fns, genes, values):
+            points.set_array(v)
+            points.set_clim(v.min(), v.max())
+            cb.set_label('%s gene expression (log2 scale)' % (gene))
+            plt.savefig(fn, bbox_inches='tight', dpi=RASTER_DPI)
+        plt.close(fig)
+
+
+def genes_exp_violin(fn, data_points, labels, cluster_colors,
+                     timestamp=False):
+    """ Makes a violin plot of number of expressed genes per cluster.
+    `data_points` holds the number of expressed genes of every cell, one
+    array per cluster. """
+    fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(7, 5))
+    vp = ax.violinplot(data_points, showmeans=False, showmedians=True)
+    for i, part in enumerate(vp['bodies']):
+        cc = cluster_colors[i]
+        part.set_facecolor(cc)
+    ax.yaxis.grid(True)
+    ax.set_xticks(list(range(1, len(labels)+1)))
+    ax.set_xticklabels(labels)
+    ax.set_xlabel('Cluster')
+    ax.set_ylabel('Number of expressed genes')
+    if timestamp:
+        plt.figtext(0.05, 0, get_time(), size=5)
+    plt.savefig(fn, bbox_inches='tight')
+    plt.close()
+
+
+def violin_top_plot(fn, clusters, timestamp=False):
+    """ Makes violin plots of the top expressed genes per cluster.
+    `clusters` is a list of (cluster, gene symbols, expression of every
+    gene in the cells of the cluster). """
+    fig_size_y = round(len(clusters)*2)
+    fig, ax = plt.subplots(nrows=len(clusters), ncols=1,
+                           figsize=(7, fig_size_y), squeeze=False)
+    ax = ax[:, 0]
+    fig.subplots_adjust(hspace=1)
+    for idx, (cluster_id, genes, data_points) in enumerate(clusters):
+        ax[idx].violinplot(list(data_points), showmeans=False,
+                           showmedians=True)
+        ax[idx].grid(axis='y')
+        ax[idx].set_xticks(list(range(1, len(genes)+1)))
+        ax[idx].set_xticklabels(genes, size=5, rotation='vertical')
+        ax[idx].set_ylabel('gene expression', size=6)
+        ax[idx].set_title('cluster %s' % cluster_id, size=6)
+        ax[idx].tick_params(axis='y', which='major', labelsize=6)
+        ax[idx].tick_params(axis='y', which='minor', labelsize=6)
+    if timestamp:
+        plt.figtext(0.05, 0, get_time(), size=5)
+    plt.savefig(fn, bbox_inches='tight')
+    plt.close()
+
+
+def marker_heatmap(fn, data, cell_counts, genes, gene_celltypes, ct_targets,
+                   ct_color, clusters_targets, cluster_colors,
+                   timestamp=False):
+    """ Makes a heatmap of the expression of the markers of the predicted
+    cell types. The cells are averaged into about as many columns as the
+    saved figure has pixels across the heatmap, which is drawn as one
+    image.
+
+    Arguments
+    =========
+    fn : Output file.
+    data : Expression of the genes (rows) in the cells (columns); cells
+        ordered by cluster.
+    cell_counts : Number of cells of every cluster in `clusters_targets`.
+    genes : Gene symbols of the rows.
+    gene_celltypes : Comma separated cell types of every gene.
+    ct_targets : The cell types.
+    ct_color : Color of every cell type.
+    clusters_targets : The clusters.
+    cluster_colors : Color of every cluster. """
+    log_debug('Generating heatmap...')
+    fig_size_y = round(data.shape[0]/8)  # 8 genes per inch
+    fig, ax = plt.subplots(
+        nrows=1, ncols=1, figsize=(15, fig_size_y))  # xy
+    # one image column per pixel of the saved figure
+    dpi = plt.rcParams['savefig.dpi']
+    if dpi == 'figure':
+        dpi = fig.dpi
+    width = ax.get_window_extent().width*dpi/fig.dpi
+    binned, bin_counts = bin_columns(data, cell_counts, int(np.ceil(width)))
+    img = ax.imshow(binned, aspect='auto', interpolation='nearest',
+                    cmap=sb.cm.rocket, vmin=data.min(), vmax=data.max(),
+                    extent=(0, binned.shape[1], data.shape[0], 0))
+    # controls size of the colorbar
+    colorbar = fig.colorbar(img, ax=ax, shrink=0.5)
+    ax.get_xaxis().set_visible(False)
+    ax.get_yaxis().set_visible(False)
+    cbar = colorbar.ax
+    cbar.set_position([0.80, 0.6, 0.19, 0.19])
+    # shuld be highest to lowest or data will flip
+    ax.set_ylim([data.shape[0], 0])
+    ax.set_xlim([0, binned.shape[1]])
+    # x coordinate is axes and y coordinate is data
+    trans = transforms.blended_transform_factory(
+        ax.transAxes, ax.transData)
+    # add gene labels
+    y_data_coord = 1  # data coordinates starts at 1
+    for gene in genes:
+        ax.text(x=-0.012-0.012*len(ct_targets), y=y_data_coord, s=gene,
+                horizontalalignment='right', clip_on=False, size=7,
+                transform=trans)
+        y_data_coord += 1
+    colorbar.ax.tick_params(labelsize=6)
+    colorbar.set_label('gene expression (log2 scale)', size=6)
+    grid = np.array(sorted(ct_targets))
+    # cell type labels
+    offset = -0.012-0.012*len(ct_targets)+0.006
+    for idx, ct in enumerate(grid):
+        ax.text(offset+idx*0.011, 0-0.50, ct, size=6,
+                rotation=90, clip_on=False, transform=trans,
+                color=ct_color[idx])
+    for index, celltypes in enumerate(gene_celltypes):
+        for p in celltypes.split(','):
+            i = np.where(grid == p)[0][0]
+            rect = mpatches.Rectangle((offset+i*0.011, index+0.3), 0.005, 0.6,
+                                      linewidth=2, facecolor=ct_color[i],
+                                      clip_on=False, transform=trans)
+            ax.add_patch(rect)
+    # add cluster indicators (x coordinates are image columns)
+    xmin = 0
+    xmax = 0
+    for cl, bin_count in zip(clusters_targets, bin_counts):
+        xmax += bin_count
+        col = cluster_colors[cl]
+        # y, xmin, xmax
+        ax.hlines(-0.5, xmin, xmax, color=col, clip_on=False, lw=4)
+        # cluster index
+        ax.text(x=xmin, y=-1.2, s=cl, size=5)
+        xmin += bin_count
+    if timestamp:
+        plt.figtext(0.05, 0.05, get_time(), size=4)
+    plt.savefig(fn, bbox_inches='tight')
+    plt.close()
+
+
+def _init_plot_worker():
+    """ Plots are rendered off-screen in the worker processes. """
+    plt.switch_backend('Agg')
+
+
+def _plot_worker(job):
+    """ Renders one plot; a job is a plotting function and its arguments. """
+    func, kwargs = job
+    func(**kwargs)
+    plt.close('all')
+
+
+def _n_values(x):
+    """ Number of values in the arrays of `x`, also in lists and tuples. """
+    if isinstance(x, np.ndarray):
+        return x.size
+    if isinstance(x, (list, tuple)):
+        return sum(_n_values(item) for item in x)
+    return 0
+
+
+def render_plots(jobs, threads=1):
+    """ Renders the plots of `jobs`, in `threads` worker processes if it is
+    larger than one and the plots hold at least PLOT_PARALLEL_MIN_VALUES
+    values; smaller plots are rendered faster than the workers start. """
+    n_values = sum(_n_values(list(kwargs.values())) for _, kwargs in jobs)
+    if threads > 1 and len(jobs) > 1 and \
+            n_values >= PLOT_PARALLEL_MIN_VALUES:
+        workers = min(threads, len(jobs))
+        with pool_context().Pool(workers,
+                                 initializer=_init_plot_worker) as pool:
+            pool.map(_plot_worker, jobs, chunksize=1)
+    else:
+        for job in jobs:
+            _plot_worker(job)
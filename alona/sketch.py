@@ -0,0 +1,139 @@
+""" alona
+
+ Description: Sketching of large datasets. A representative subset of cells
+ (the sketch) is selected in PCA space, clustered and embedded, and the
+ results are transferred to the remaining cells from their nearest sketch
+ neighbours.
+
+ The sketch is selected with density-dependent downsampling as in SPADE:
+ cells in dense regions are kept with lower probability than cells in
+ sparse regions, so that small populations are represented in the sketch
+ while the relative layout of the data is preserved.
+
+ Qiu P, et al. Extracting a cellular hierarchy from high-dimensional
+ cytometry data with SPADE. Nature Biotechnology 29:886-891, 2011.
+
+ How to use: https://github.com/oscar-franzen/alona/
+
+ Contact: Oscar Franzen <p.oscar.franzen@gmail.com> """
+
+import numpy as np
+
+from .knn import knn_blocked
+
+# number of reference neighbours used to estimate the local density
+DENSITY_K = 50
+# the radius used to count neighbours is the median distance to this
+# reference neighbour
+DENSITY_RADIUS_K = 10
+
+
+def local_density(x, n_ref, rng, threads=1):
+    """ Estimates the local density of every cell as the number of cells of a
+    random reference subset found within a fixed radius. The radius is the
+    median distance to the DENSITY_RADIUS_K-th reference neighbour, so that
+    a typical cell has about DENSITY_RADIUS_K cells within it.
+
+    Returns
+    =======
+    An array of counts (at least one). """
+    n_cells = x.shape[0]
+    ref = rng.choice(n_cells, size=min(n_cells, n_ref), replace=False)
+    k = min(DENSITY_K, len(ref))
+    _, dist = knn_blocked(x, k, y=x[ref], threads=threads)
+    radius = np.median(dist[:, min(DENSITY_RADIUS_K, k)-1])
+    counts = np.sum(dist <= radius, axis=1)
+    return np.maximum(counts, 1)
+
+
+def density_sample(x, size, seed=None, threads=1):
+    """ Selects about `size` cells with density-dependent downsampling.
+
+    A cell with local density d is kept with probability min(1, t/d), where
+    the target density t is found with a binary search so that the expected
+    number of selected cells is `size`.
+
+    Arguments
+    =========
+    x : Cells in PCA space (n x d).
+    size : The requested number of cells.
+    seed : Seed of the random number generator.
+    threads : Number of threads.
+
+    Returns
+    =======
+    Sorted positional indices of the selected cells. """
+    n_cells = x.shape[0]
+    if size >= n_cells:
+        return np.arange(n_cells)
+    rng = np.random.default_rng(seed)
+    density = local_density(x, size, rng, threads)
+    lo, hi = 0.0, float(density.max())
+    for _ in range(100):
+        target = (lo+hi)/2
+        expected = np.minimum(1, target/density).sum()
+        if abs(expected - size) < 0.5:
+            break
+        if expected < size:
+            lo = target
+        else:
+            hi = target
+    keep = rng.random(n_cells) < np.minimum(1, target/density)
+    return np.flatnonzero(keep)
+
+
+def _neighbour_weights(nn_dist):
+    """ Inverse distance weights; an exact match gets all the weight. """
+    nn_dist = np.asarray(nn_dist, dtype=np.float64)
+    exact = nn_dist[:, :1] == 0
+    with np.errstate(divide='ignore'):
+        w = 1/nn_dist
+    w = np.where(exact, (nn_dist == 0).astype(np.float64), w)
+    return w
+
+
+def transfer_labels(nn_idx, nn_dist, labels):
+    """ Assigns every cell the label with the largest inverse distance
+    weighted vote among its nearest sketch neighbours.
+
+    Arguments
+    =========
+    nn_idx : Zero-based indices of the sketch neighbours of every cell
+        (n x k).
+    nn_dist : Corresponding distances (n x k).
+    labels : Labels of the sketch cells.
+
+    Returns
+    =======
+    A tuple: the labels of all cells and the fraction of the votes that the
+    assigned label received. """
+    codes, labels_int = np.unique(np.asarray(labels), return_inverse=True)
+    n_cells = nn_idx.shape[0]
+    n_codes = len(codes)
+    w = _neighbour_weights(nn_dist)
+    neighbour_labels = labels_int[nn_idx]
+    rows = np.repeat(np.arange(n_cells), nn_idx.shape[1])
+    votes = np.bincount(rows*n_codes + neighbour_labels.ravel(), w.ravel(),
+                        minlength=n_cells*n_codes).reshape(n_cells, n_codes)
+    best = np.argmax(votes, axis=1)
+    fraction = votes[np.arange(n_cells), best]/votes.sum(axis=1)
+    return codes[best], fraction
+
+
+def transfer_positions(nn_idx, nn_dist, coordinates, nn_labels=None,
+                       labels=None):
+    """ Places every cell at the inverse distance weighted mean position of
+    its nearest sketch neighbours. If the labels of the neighbours and the
+    labels of the cells are given, only neighbours with the same label as
+    the cell are used, which avoids placing cells between clusters.
+
+    Returns
+    =======
+    An n x 2 array. """
+    w = _neighbour_weights(nn_dist)
+    if labels is not None:
+        same = nn_labels == np.asarray(labels)[:, None]
+        w = w*same
+    w = w/w.sum(axis=1)[:, None]
+    coordinates = np.asarray(coordinates, dtype=np.float64)
+    return np.einsum('nk,nkd->nd', w, coordinates[nn_idx])
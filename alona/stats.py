@@ -6,7 +6,11 @@
 
  Contact: Oscar Franzen <p.oscar.franzen@gmail.com> """
 
+import warnings
+
 import numpy as np
+import scipy.stats
+from scipy import sparse
 
 
 def p_adjust_bh(p):
@@ -18,3 +22,337 @@ def p_adjust_bh(p):
     steps = float(len(p)) / np.arange(float(len(p)), 0, -1)
     q = np.minimum(1, np.minimum.accumulate(steps * p[by_descend]))
     return q[by_orig]
+
+
+def cluster_stats(x, labels, n_clusters, block_size=4096):
+    """ Computes the sufficient statistics of every gene in every cluster:
+    the number of cells, the sum, the sum of squares and the number of cells
+    with nonzero expression. Cells are summed per cluster with a sparse
+    indicator matrix, in blocks of genes to limit the memory used for the
+    squares.
+
+    Arguments
+    =========
+    x : Gene expression (genes x cells), a numpy array or a scipy sparse
+        matrix.
+    labels : Integer cluster labels (0, ..., n_clusters-1) of the cells.
+    n_clusters : Number of clusters.
+    block_size : Number of genes in one block.
+
+    Returns
+    =======
+    A tuple: cells per cluster (n_clusters), sums, sums of squares and
+    numbers of expressing cells (n_clusters x genes). """
+    labels = np.asarray(labels)
+    n_genes, n_cells = x.shape
+    indicator = sparse.csr_matrix((np.ones(n_cells), (np.arange(n_cells),
+                                                      labels)),
+                                  shape=(n_cells, n_clusters))
+    n = np.bincount(labels, minlength=n_clusters)
+    sums = np.empty((n_clusters, n_genes))
+    sumsq = np.empty((n_clusters, n_genes))
+    nnz = np.empty((n_clusters, n_genes))
+    is_sparse = sparse.issparse(x)
+    if is_sparse:
+        x = sparse.csr_matrix(x, dtype=np.float64)
+    for start in range(0, n_genes, block_size):
+        end = min(start + block_size, n_genes)
+        block = x[start:end]
+        if is_sparse:
+            sums[:, start:end] = (block @ indicator).T.toarray()
+            squares = block.multiply(block)
+            sumsq[:, start:end] = (squares @ indicator).T.toarray()
+            nnz[:, start:end] = ((block != 0) @ indicator).T.toarray()
+        else:
+            block = np.asarray(block, dtype=np.float64)
+            sums[:, start:end] = (indicator.T @ block.T)
+            sumsq[:, start:end] = (indicator.T @ (block**2).T)
+            nnz[:, start:end] = (indicator.T @ (block != 0).T)
+    return n, sums, sumsq, nnz
+
+
+def cluster_means(x, labels, n_clusters, block_size=4096):
+    """ Computes the mean of every gene in every cluster by multiplying
+    blocks of genes with a sparse cluster indicator matrix.
+
+    Arguments
+    =========
+    x : Expression matrix (genes x cells), dense or sparse.
+    labels : Integer cluster codes (0..n_clusters-1) of the cells; cells
+        with larger codes are ignored.
+    n_clusters : Number of clusters.
+
+    Returns
+    =======
+    An array of means (genes x n_clusters). """
+    labels = np.asarray(labels)
+    n_genes, n_cells = x.shape
+    use = labels < n_clusters
+    indicator = sparse.csr_matrix((np.ones(np.sum(use)),
+                                   (np.flatnonzero(use), labels[use])),
+                                  shape=(n_cells, n_clusters))
+    n = np.bincount(labels[use], minlength=n_clusters)
+    out = np.empty((n_genes, n_clusters))
+    is_sparse = sparse.issparse(x)
+    if is_sparse:
+        x = sparse.csr_matrix(x, dtype=np.float64)
+    for start in range(0, n_genes, block_size):
+        end = min(start + block_size, n_genes)
+        block = x[start:end]
+        if is_sparse:
+            out[start:end] = (block @ indicator).toarray()
+        else:
+            out[start:end] = (indicator.T @ np.asarray(block).T).T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return out/n
+
+
+def _median_rows(block):
+    """ Median of every row. Rows where both middle order statistics are
+    zeros are answered from the counts of negative and zero values; only
+    the remaining rows are partitioned. """
+    n_rows, n = block.shape
+    lo, hi = (n-1)//2, n//2
+    if sparse.issparse(block):
+        block = sparse.csr_matrix(block)
+        block.eliminate_zeros()
+        n_neg = np.asarray((block < 0).sum(axis=1)).ravel()
+        n_zero = n - np.diff(block.indptr)
+    else:
+        n_neg = np.sum(block < 0, axis=1)
+        n_zero = np.sum(block == 0, axis=1)
+    med = np.zeros(n_rows)
+    rest = np.flatnonzero((n_neg > lo) | (n_neg + n_zero <= hi))
+    if len(rest):
+        values = block[rest]
+        if sparse.issparse(values):
+            values = values.toarray()
+        part = np.partition(values, [lo, hi], axis=1)
+        med[rest] = (part[:, lo] + part[:, hi])/2
+    return med
+
+
+def cluster_medians(x, labels, n_clusters):
+    """ Computes the median of every gene in every cluster. The cells of
+    one cluster are taken at a time (column blocks of a CSC matrix if x is
+    sparse) and medians are found with partial sorting, skipping genes
+    whose median is zero (see _median_rows()).
+
+    Arguments
+    =========
+    x : Expression matrix (genes x cells), dense or sparse.
+    labels : Integer cluster codes (0..n_clusters-1) of the cells; cells
+        with larger codes are ignored.
+    n_clusters : Number of clusters.
+
+    Returns
+    =======
+    An array of medians (genes x n_clusters). """
+    labels = np.asarray(labels)
+    if sparse.issparse(x):
+        x = sparse.csc_matrix(x, dtype=np.float64)
+    else:
+        x = np.asarray(x)
+    out = np.full((x.shape[0], n_clusters), np.nan)
+    for code in range(n_clusters):
+        cells = np.flatnonzero(labels == code)
+        if len(cells):
+            out[:, code] = _median_rows(x[:, cells])
+    return out
+
+
+def pairwise_t_tests(n, sums, sumsq):
+    """ Pairwise comparisons of cluster means with t-tests using the pooled
+    residual variance of a linear model with one coefficient per cluster
+    (the cluster means), computed in closed form from sufficient
+    statistics (see cluster_stats()).
+
+    Pairs (k, i) with i < k are in the order k = 1, ..., K-1 and for every
+    k i = 0, ..., k-1 (lower triangle, row by row).
+
+    Returns
+    =======
+    A tuple: the indices k and i of the pairs, the cluster means (K x
+    genes), the differences of the means mean_k - mean_i (pairs x genes),
+    the t-statistics (pairs x genes) and the residual degrees of
+    freedom. """
+    n = np.asarray(n, dtype=np.float64)
+    means = sums/n[:, None]
+    df = n.sum() - len(n)
+    # residual sum of squares around the cluster means
+    rss = sumsq.sum(axis=0) - (n[:, None]*means**2).sum(axis=0)
+    sigma2 = np.maximum(rss, 0)/df
+    k_idx, i_idx = np.tril_indices(len(n), -1)
+    diff = means[k_idx] - means[i_idx]
+    std_err = np.sqrt((1/n[k_idx] + 1/n[i_idx])[:, None]*sigma2[None, :])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_stat = diff/std_err
+    return k_idx, i_idx, means, diff, t_stat, df
+
+
+def simes(p, n_tests=None):
+    """ Combines p-values along the last axis with Simes' method,
+    min_j(m * p_j / r_j), where r_j is the rank of p_j. Ties get the
+    average rank and NaN values are ignored (as with `pandas.rank()`).
+    Tied values share the same rank, so the minimum is found directly on
+    the sorted values without ranking the original array; average ranks
+    are only computed for rows with ties.
+
+    Arguments
+    =========
+    p : An array of p-values.
+    n_tests : The number of tests m, can be an array broadcast against the
+        result. Defaults to the length of the last axis.
+
+    Returns
+    =======
+    The combined p-values (not capped at one). """
+    p = np.asarray(p, dtype=np.float64)
+    if n_tests is None:
+        n_tests = p.shape[-1]
+    n = p.shape[-1]
+    # NaN values are sorted last and do not affect the ranks of the others
+    s = np.sort(p, axis=-1)
+    ranks = np.broadcast_to(np.arange(1, n+1, dtype=np.float64), s.shape)
+    tied = s[..., 1:] == s[..., :-1]
+    has_ties = tied.any(axis=-1)
+    if has_ties.any():
+        # average ranks, only computed where there are ties: first and last
+        # position of every group of tied values
+        st = s[has_ties]
+        pos = ranks[has_ties]
+        start = np.ones(st.shape, dtype=bool)
+        start[..., 1:] = np.logical_not(tied[has_ties])
+        end = np.ones(st.shape, dtype=bool)
+        end[..., :-1] = start[..., 1:]
+        first = np.maximum.accumulate(np.where(start, pos, 0), axis=-1)
+        last = np.minimum.accumulate(np.where(end, pos, n+1)[..., ::-1],
+                                     axis=-1)[..., ::-1]
+        ranks = ranks.copy()
+        ranks[has_ties] = (first+last)/2
+    m = np.asarray(n_tests, dtype=np.float64)[..., None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = m*s/ranks
+    with warnings.catch_warnings():
+        # rows without any p-value give NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmin(t, axis=-1)
+
+
+def rank_sum_block(x, codes, n_clusters):
+    """ Computes the Mann-Whitney U statistics of all ordered pairs of
+    clusters for a block of genes. The values of every gene are sorted once
+    over all cells. For sparse data only the nonzero values are sorted; the
+    zeros form a single group of tied values whose size per cluster is known
+    from the number of nonzero values.
+
+    With A the counts of every cluster in every group of tied values (in
+    increasing order of value) and B the number of cells of every cluster
+    with a smaller value plus half of the tied ones, U = A'B, i.e.
+    U[a, b] counts the pairs of cells (a, b) where the cell in a has the
+    larger value (ties count one half).
+
+    Arguments
+    =========
+    x : Gene expression (genes x cells), a numpy array or a scipy sparse
+        matrix.
+    codes : Integer cluster labels of the cells; cells labeled
+        `n_clusters` or higher are ignored.
+    n_clusters : Number of clusters.
+
+    Returns
+    =======
+    A tuple: cells per cluster (n_clusters), U (genes x clusters x
+    clusters), the tie term sum(t^3 - t) of every pair of clusters (genes x
+    clusters x clusters) and the tie term over all clusters (genes). """
+    codes = np.asarray(codes)
+    valid = codes < n_clusters
+    n = np.bincount(codes[valid], minlength=n_clusters)
+    is_sparse = sparse.issparse(x)
+    if is_sparse:
+        x = sparse.csr_matrix(x)
+    n_genes = x.shape[0]
+    U = np.empty((n_genes, n_clusters, n_clusters))
+    ties = np.empty((n_genes, n_clusters, n_clusters))
+    ties_all = np.empty(n_genes)
+    for g in range(n_genes):
+        if is_sparse:
+            lo, hi = x.indptr[g], x.indptr[g+1]
+            idx = x.indices[lo:hi]
+            vals = x.data[lo:hi]
+            nz = vals != 0
+            idx, vals = idx[nz], vals[nz]
+        else:
+            row = np.asarray(x[g]).ravel()
+            idx = np.flatnonzero(row)
+            vals = row[idx]
+        cl = codes[idx]
+        keep = cl < n_clusters
+        cl, vals = cl[keep], vals[keep]
+        order = np.argsort(vals, kind='stable')
+        vals, cl = vals[order], cl[order]
+        new_group = np.ones(len(vals), dtype=bool)
+        new_group[1:] = vals[1:] != vals[:-1]
+        group = np.cumsum(new_group) - 1
+        n_groups = group[-1] + 1 if len(group) else 0
+        # the zero group is placed between negative and positive values
+        zero_pos = np.searchsorted(vals[new_group], 0)
+        group[group >= zero_pos] += 1
+        A = np.bincount(group*n_clusters + cl,
+                        minlength=(n_groups+1)*n_clusters)
+        A = A.reshape(n_groups+1, n_clusters).astype(np.float64)
+        A[zero_pos] = n - A.sum(axis=0)
+        B = np.cumsum(A, axis=0) - 0.5*A
+        U[g] = A.T @ B
+        # sum over groups of (c_a + c_b)^3 - (c_a + c_b)
+        A2 = A**2
+        cross = A2.T @ A
+        own = (A2*A - A).sum(axis=0)
+        ties[g] = own[:, None] + own[None, :] + 3*(cross + cross.T)
+        total = A.sum(axis=1)
+        ties_all[g] = (total**3 - total).sum()
+    return n, U, ties, ties_all
+
+
+def mann_whitney_tails(U, n1, n2, ties):
+    """ Normal approximation of the distribution of the Mann-Whitney U
+    statistic with tie and continuity correction (as `mannwhitneyu()` in
+    scipy).
+
+    Arguments
+    =========
+    U : U statistics of the first group.
+    n1, n2 : Group sizes (broadcast against U).
+    ties : The tie term sum(t^3 - t) over groups of tied values.
+
+    Returns
+    =======
+    A tuple of p-values: values of the first group are lower (left) or
+    higher (right) than the values of the second group. """
+    n1 = np.asarray(n1, dtype=np.float64)
+    n2 = np.asarray(n2, dtype=np.float64)
+    N = n1 + n2
+    mu = n1*n2/2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sigma = np.sqrt(n1*n2/12*((N+1) - ties/(N*(N-1))))
+        right = scipy.stats.norm.sf((U - mu - 0.5)/sigma)
+        left = scipy.stats.norm.cdf((U - mu + 0.5)/sigma)
+    return left, right
+
+
+def fisher_exact_greater(a, b, c, d):
+    """ One-sided (alternative 'greater') Fisher's exact test of many 2x2
+    tables [[a, b], [c, d]] at once; same as scipy.stats.fisher_exact() per
+    table. The p-value is the upper tail of the hypergeometric distribution
+    of a given the margins of the table, computed as the lower tail of b
+    (as scipy does) for accuracy. Tables with an empty row or column get a
+    p-value of 1.
+
+    Returns
+    =======
+    An array of p-values with the shape of the inputs. """
+    a, b, c, d = (np.asarray(v, dtype=np.int64) for v in (a, b, c, d))
+    empty = (a+b == 0) | (c+d == 0) | (a+c == 0) | (b+d == 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pv = scipy.stats.hypergeom.cdf(b, a+b+c+d, a+b, b+d)
+    return np.where(empty, 1.0, np.minimum(pv, 1.0))
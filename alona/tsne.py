@@ -0,0 +1,257 @@
+""" alona
+
+ Description: Fast t-SNE with interpolation-based repulsive forces.
+
+ The attractive forces are computed from a sparse affinity matrix built
+ from the k nearest neighbours of every point (k = 3*perplexity). The
+ repulsive forces, which in exact t-SNE require all pairwise interactions,
+ are approximated by spreading the points onto a regular grid, convolving
+ the grid with the t-SNE kernels using FFT, and interpolating the result
+ back to the points (cubic Lagrange interpolation). The cost of one iteration is
+ O(N + G log G), where G is the number of grid nodes.
+
+ References:
+
+ van der Maaten, L.J.P.; Hinton, G.E. Visualizing High-Dimensional Data
+ Using t-SNE. Journal of Machine Learning Research 9:2579-2605, 2008.
+
+ Linderman GC, Rachh M, Hoskins JG, Steinerberger S, Kluger Y. Fast
+ interpolation-based t-SNE for improved visualization of single-cell
+ RNA-seq data. Nature Methods 16:243-245, 2019.
+
+ Belkina AC, et al. Automated optimized parameters for T-distributed
+ stochastic neighbor embedding improve visualization and analysis of large
+ datasets. Nature Communications 10:5415, 2019.
+
+ How to use: https://github.com/oscar-franzen/alona/
+
+ Contact: Oscar Franzen <p.oscar.franzen@gmail.com> """
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.fft
+from scipy.sparse import csr_matrix
+
+from .log import log_debug
+
+# grid nodes per unit of embedding space and bounds on the grid size
+GRID_PER_UNIT = 3
+MIN_GRID = 32
+MAX_GRID = 512
+
+
+def joint_probabilities(nn_idx, nn_dist, perplexity, tol=1e-5, max_iter=100):
+    """ Computes the symmetric affinity matrix P from the nearest
+    neighbours of every point. The Gaussian bandwidth of every point is
+    found with a binary search, vectorized over all points, so that the
+    conditional distribution has the requested perplexity.
+
+    Arguments
+    =========
+    nn_idx : Zero-based indices of the neighbours (n x k), self excluded.
+    nn_dist : The corresponding distances (n x k).
+    perplexity : The perplexity.
+
+    Returns
+    =======
+    A sparse n x n matrix (CSR) summing to one. """
+    n_points, k = nn_idx.shape
+    d2 = nn_dist.astype(np.float64)**2
+    # subtracting the smallest distance does not change the normalized
+    # probabilities but avoids underflow
+    d2 = d2 - d2[:, :1]
+    target = np.log(perplexity)
+    beta = np.ones(n_points)
+    lo = np.zeros(n_points)
+    hi = np.full(n_points, np.inf)
+    for _ in range(max_iter):
+        p = np.exp(-d2*beta[:, None])
+        sum_p = p.sum(axis=1)
+        entropy = np.log(sum_p) + beta*(d2*p).sum(axis=1)/sum_p
+        diff = entropy - target
+        if np.all(np.abs(diff) < tol):
+            break
+        # entropy too high: the distribution is too flat, increase beta
+        up = diff > 0
+        lo[up] = beta[up]
+        hi[~up] = beta[~up]
+        beta = np.where(np.isinf(hi), beta*2, (lo+hi)/2)
+    p = p/sum_p[:, None]
+    rows = np.repeat(np.arange(n_points), k)
+    P = csr_matrix((p.ravel(), (rows, nn_idx.ravel())),
+                   shape=(n_points, n_points))
+    P = P + P.transpose()
+    P = P.multiply(1/P.sum()).tocsr()
+    return P
+
+
+def _attractive_forces(P, rows, Y, threads):
+    """ Computes sum_j p_ij q_ij Z (y_i - y_j) for every point, i.e. the
+    attractive part of the gradient. `rows` holds the row index of every
+    stored element of P. Row blocks of P are processed in parallel. """
+    n_points = Y.shape[0]
+    out = np.empty_like(Y)
+    chunk = -(-n_points//threads)
+    starts = list(range(0, n_points, chunk))
+    y0 = np.ascontiguousarray(Y[:, 0])
+    y1 = np.ascontiguousarray(Y[:, 1])
+
+    def _job(start):
+        end = min(start + chunk, n_points)
+        lo, hi = P.indptr[start], P.indptr[end]
+        r = rows[lo:hi]
+        c = P.indices[lo:hi]
+        d0 = y0[r] - y0[c]
+        d1 = y1[r] - y1[c]
+        w = P.data[lo:hi]/(1+d0*d0+d1*d1)
+        out[start:end, 0] = np.bincount(r-start, w*d0, minlength=end-start)
+        out[start:end, 1] = np.bincount(r-start, w*d1, minlength=end-start)
+
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(_job, starts))
+    else:
+        for start in starts:
+            _job(start)
+    return out
+
+
+def _lagrange_weights(t):
+    """ Cubic Lagrange interpolation weights of the nodes -1, 0, 1, 2 for
+    fractional positions t in [0, 1). Returns an array of shape (n, 4). """
+    return np.column_stack((-t*(t-1)*(t-2)/6,
+                            (t+1)*(t-1)*(t-2)/2,
+                            -(t+1)*t*(t-2)/2,
+                            (t+1)*t*(t-1)/6))
+
+
+def _repulsive_forces(Y, threads):
+    """ Approximates the repulsive part of the gradient using grid
+    interpolation and FFT convolution. Every point is spread onto the
+    4 x 4 surrounding grid nodes with cubic Lagrange weights, the grid is
+    convolved with the kernels and the potentials are interpolated back
+    with the same weights.
+
+    Returns the unnormalized repulsive forces sum_j (q_ij Z)^2 (y_i - y_j)
+    and the normalization term Z = sum_{i != j} (1 + ||y_i - y_j||^2)^-1. """
+    n_points = Y.shape[0]
+    ymin = Y.min(axis=0)
+    extent = max((Y.max(axis=0) - ymin).max(), 1e-8)
+    n_inner = int(np.clip(np.ceil(extent*GRID_PER_UNIT)+1, MIN_GRID, MAX_GRID))
+    h = extent/(n_inner-1)
+    # one extra node on each side for the interpolation stencil
+    n_grid = n_inner + 3
+    pos = (Y - ymin)/h
+    idx = np.minimum(pos.astype(np.int64), n_inner-2)
+    frac = pos - idx
+    wx = _lagrange_weights(frac[:, 0])
+    wy = _lagrange_weights(frac[:, 1])
+    # (n x 16) stencil nodes and weights
+    stencil = np.arange(4)
+    nodes = ((idx[:, 0, None] + stencil)[:, :, None]*n_grid +
+             (idx[:, 1, None] + stencil)[:, None, :]).reshape(n_points, 16)
+    weights = (wx[:, :, None]*wy[:, None, :]).reshape(n_points, 16)
+    flat_nodes = nodes.ravel()
+    charges = (np.ones(n_points), Y[:, 0], Y[:, 1])
+    # zero padding avoids wrap-around in the circular convolution
+    size = scipy.fft.next_fast_len(2*n_grid-1, real=True)
+    grid = np.zeros((len(charges), size, size))
+    for c, q in enumerate(charges):
+        g = np.bincount(flat_nodes, (weights*q[:, None]).ravel(),
+                        minlength=n_grid*n_grid)
+        grid[c, :n_grid, :n_grid] = g.reshape(n_grid, n_grid)
+    # kernels evaluated at all grid offsets (negative offsets wrap around)
+    off = np.arange(size)
+    off = np.where(off < size-n_grid+1, off, off-size)*h
+    r2 = off[:, None]**2 + off[None, :]**2
+    k1 = 1/(1+r2)
+    k2 = k1**2
+    f_grid = scipy.fft.rfft2(grid, workers=threads)
+    f_k1 = scipy.fft.rfft2(k1, workers=threads)
+    f_k2 = scipy.fft.rfft2(k2, workers=threads)
+    pot = np.empty((4, n_grid*n_grid))
+    conv = ((f_k1, 0), (f_k2, 0), (f_k2, 1), (f_k2, 2))
+    for i, (f_k, c) in enumerate(conv):
+        res = scipy.fft.irfft2(f_grid[c]*f_k, s=(size, size), workers=threads)
+        pot[i] = res[:n_grid, :n_grid].ravel()
+    # interpolate the potentials back to the points
+    phi = np.einsum('knj,nj->kn', pot[:, nodes], weights)
+    # the interpolated self interaction of a point is not exactly
+    # K(0) = 1; remove the self interaction as seen through the grid. The
+    # stencil offsets are the same for every point.
+    sx, sy = np.meshgrid(stencil, stencil, indexing='ij')
+    sx, sy = sx.ravel()*h, sy.ravel()*h
+    k_local = 1/(1+(sx[:, None]-sx[None, :])**2+(sy[:, None]-sy[None, :])**2)
+    self_k1 = np.einsum('ni,ij,nj->n', weights, k_local, weights)
+    Z = phi[0].sum() - self_k1.sum()
+    # the self interaction cancels in the repulsive forces
+    rep = Y*phi[1][:, None] - phi[2:].T
+    return rep, Z
+
+
+def tsne(X, nn_idx, nn_dist, perplexity=30, n_iter=None,
+         early_exaggeration=12, exaggeration_iter=250, learning_rate=None,
+         threads=1):
+    """ Projects data to two dimensions with t-SNE.
+
+    Arguments
+    =========
+    X : Input data (n x d), usually principal components. The first two
+        columns are used for initialization and should therefore be the
+        two first principal components.
+    nn_idx : Zero-based indices of the nearest neighbours of every point
+        (n x k, excluding the point itself); k should be about
+        3*perplexity.
+    nn_dist : Distances to the nearest neighbours (n x k).
+    perplexity : The perplexity.
+    n_iter : Number of iterations after early exaggeration. If None, it
+        is set from the number of points (500-1000) and the optimization
+        stops early when the embedding no longer changes.
+    early_exaggeration : Exaggeration of the attractive forces during the
+        first `exaggeration_iter` iterations.
+    learning_rate : If None, set to N/early_exaggeration/4 (Belkina et al.
+        2019; the factor 4 is part of the gradient here).
+    threads : Number of threads.
+
+    Returns
+    =======
+    An n x 2 array. """
+    X = np.asarray(X, dtype=np.float64)
+    n_points = X.shape[0]
+    auto_iter = n_iter is None
+    if auto_iter:
+        n_iter = int(np.clip(n_points/100, 500, 1000))
+    if learning_rate is None:
+        learning_rate = max(n_points/early_exaggeration/4, 50)
+    P = joint_probabilities(nn_idx, nn_dist, perplexity)
+    # PCA initialization, scaled to a small standard deviation
+    Y = X[:, :2] - X[:, :2].mean(axis=0)
+    Y = Y/np.std(Y[:, 0])*1e-4
+    update = np.zeros_like(Y)
+    gains = np.ones_like(Y)
+    rows = np.repeat(np.arange(n_points), np.diff(P.indptr))
+    total = exaggeration_iter + n_iter
+    for it in range(total):
+        if it < exaggeration_iter:
+            exaggeration, momentum = early_exaggeration, 0.5
+        else:
+            exaggeration, momentum = 1, 0.8
+        attr = _attractive_forces(P, rows, Y, threads)
+        rep, Z = _repulsive_forces(Y, threads)
+        grad = 4*(exaggeration*attr - rep/Z)
+        inc = update*grad < 0
+        gains[inc] += 0.2
+        gains[~inc] *= 0.8
+        np.clip(gains, 0.01, None, out=gains)
+        update = momentum*update - learning_rate*gains*grad
+        Y += update
+        Y -= Y.mean(axis=0)
+        if it % 50 == 0:
+            change = np.linalg.norm(update)/np.linalg.norm(Y)
+            log_debug('t-SNE iteration %s/%s, relative change %.2e' %
+                      (it, total, change))
+            if auto_iter and it > exaggeration_iter and change < 1e-4:
+                log_debug('t-SNE converged')
+                break
+    return Y
@@ -11,6 +11,7 @@ import inspect
 import uuid
 import time
 import datetime
+import multiprocessing
 
 import numpy as np
 from sklearn.cluster import KMeans
@@ -49,6 +50,21 @@ def print_version(ctx, param, value):
     ctx.exit()
 
 
+def pool_context():
+    """ Returns the multiprocessing context used for the worker pools.
+    Forking a process after a thread pool has been started in it (e.g. the
+    one of numba, which is used by UMAP) can deadlock the child or the
+    parent at exit, so workers are started from a fork server, or spawned
+    where a fork server is not available. Worker arguments must therefore
+    be picklable. The fork server only imports the worker functions
+    (alona.workers), which is fast, and every worker is forked from it. """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context('forkserver')
+        ctx.set_forkserver_preload(['alona.workers'])
+        return ctx
+    return multiprocessing.get_context('spawn')
+
+
 def get_alona_dir():
     """ Returns the alona base directory. """
     return os.path.dirname(inspect.getfile(log_error)) + '/'
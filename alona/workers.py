@@ -0,0 +1,129 @@
+""" alona
+
+ Description: Functions run in the worker processes of alona.
+
+ The fork server of the worker pools (see utils.pool_context()) imports
+ this module only, so it must not import the heavy parts of alona (e.g.
+ UMAP and numba through clustering.py).
+
+ How to use: https://github.com/oscar-franzen/alona/
+
+ Contact: Oscar Franzen <p.oscar.franzen@gmail.com> """
+
+from multiprocessing import shared_memory
+
+import numpy as np
+import leidenalg
+
+from .stats import (rank_sum_block, mann_whitney_tails)
+
+
+def leiden_partition(g, partition, res, seed):
+    """ Runs the Leiden algorithm on the weighted graph `g`. `partition`
+    is the name of the partition type; the resolution parameter is only
+    used by RBERVertexPartition. """
+    kwargs = {'weights': 'weight', 'n_iterations': 10, 'seed': seed}
+    if partition == 'ModularityVertexPartition':
+        part = leidenalg.ModularityVertexPartition
+    else:
+        part = leidenalg.RBERVertexPartition
+        kwargs['resolution_parameter'] = res
+    return leidenalg.find_partition(g, part, **kwargs)
+
+
+# graph shared by the worker processes of the resolution sweep
+_SWEEP = {}
+
+
+def init_sweep_worker(g, partition, seed):
+    """ Stores the graph once per worker process. """
+    _SWEEP['graph'] = g
+    _SWEEP['partition'] = partition
+    _SWEEP['seed'] = seed
+
+
+def sweep_worker(res):
+    """ Runs Leiden for one resolution on the graph of the worker. """
+    g = _SWEEP['graph']
+    cl = leiden_partition(g, _SWEEP['partition'], res, _SWEEP['seed'])
+    return cl.membership, g.modularity(cl.membership, weights='weight')
+
+
+# marker matrix and scores shared by the permutation worker processes
+_PERM = {}
+
+
+def init_perm_worker(member_rows, median_expr_Z, norm, activity):
+    """ Stores the marker matrix, the Z-scores, the normalization of the
+    activity scores and the observed activity scores once per worker
+    process. """
+    _PERM['member_rows'] = member_rows
+    _PERM['Z'] = median_expr_Z
+    _PERM['norm'] = norm
+    _PERM['activity'] = activity
+
+
+def perm_worker(task):
+    """ Runs one batch of permutations of the gene labels. The batch has
+    its own random number stream (a child of the seed sequence), so the
+    result does not depend on the worker running it.
+
+    Returns
+    =======
+    The number of permutations in which the activity score of every cell
+    type and cluster is at least the observed score. """
+    seed_seq, n_perm = task
+    rng = np.random.default_rng(seed_seq)
+    Z = _PERM['Z']
+    n_genes, n_clusters = Z.shape
+    perms = np.tile(np.arange(n_genes), (n_perm, 1))
+    rng.permuted(perms, axis=1, out=perms)
+    # genes x (permutations*clusters)
+    Z_perm = Z[perms].transpose(1, 0, 2).reshape(n_genes, -1)
+    score = (_PERM['member_rows'] @ Z_perm).reshape(-1, n_perm, n_clusters)
+    score /= _PERM['norm'][:, None, None]
+    return np.sum(score >= _PERM['activity'][:, None, :], axis=1)
+
+
+# array and arguments of the DE tests in a worker process; the array is
+# attached through shared memory
+_DE = {}
+
+
+def choose_leftright_pvalues(left, right, direction):
+    """ P-values of a test in the direction `direction` ('up', 'down' or
+    'any') from the p-values of the lower and the upper tail. """
+    if direction == 'up':
+        pv = right
+    elif direction == 'down':
+        pv = left
+    else:
+        pv = np.minimum(left, right)*2
+    return pv
+
+
+def init_de_worker(name, shape, dtype, args):
+    """ Attaches to the array in shared memory once per worker process and
+    stores the remaining arguments. """
+    shm = shared_memory.SharedMemory(name=name)
+    _DE['shm'] = shm
+    _DE['x'] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _DE.update(args)
+
+
+def wilcoxon_worker(start):
+    """ Wilcoxon tests of one block of genes (rows of the expression
+    matrix). Returns the pairwise p-values (genes x clusters x clusters) and
+    the one-vs-rest U statistics and p-values (genes x clusters). """
+    x = _DE['x'][start:start+_DE['block']]
+    direction = _DE['direction']
+    choose = choose_leftright_pvalues
+    n, U, ties, ties_all = rank_sum_block(x, _DE['codes'], _DE['n_clusters'])
+    n_rest = n.sum() - n
+    left, right = mann_whitney_tails(U, n[:, None], n[None, :], ties)
+    pv = np.minimum(choose(left, right, direction), 1)
+    # U[a, a] is always n_a^2/2
+    u_rest = U.sum(axis=2) - n**2/2
+    left, right = mann_whitney_tails(u_rest, n, n_rest, ties_all[:, None])
+    ovr_pv = np.minimum(choose(left, right, direction), 1)
+    return pv, u_rest, ovr_pv
@@ -20,10 +20,11 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     install_requires=['click>=7.0', 'matplotlib>=3.0.3', 'numpy>=1.16.3',
                       'pandas>=0.24.2', 'scipy>=1.2.1', 'scikit-learn>=0.21.0',
-                      'leidenalg>=0.7.0', 'umap-learn>=0.3.9', 'statsmodels>=0.9.0',
-                      'python-igraph>=0.7.1', 'seaborn>=0.9.0', 'patsy>=0.5.1'],
+                      'leidenalg>=0.7.0', 'umap-learn>=0.5.0',
+                      'python-igraph>=0.10.0', 'seaborn>=0.9.0',
+                      'pyarrow>=1.0.0'],
     include_package_data=True,
-    python_requires='>=3.6',
+    python_requires='>=3.8',
     zip_safe=False,
     classifiers=[
         "Programming Language :: Python :: 3",